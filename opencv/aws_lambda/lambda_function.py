@@ -1,16 +1,55 @@
-import cv2
+# Contour service behind API Gateway. Requests come in one of three forms:
+#   application/json     {"image": "data:image/png;base64,...", "area": [x, y, w, h]}, the
+#                        original payload, base64 encoded by the app or plain
+#   image/*              the encoded image as the body, area as a JSON query parameter
+#   multipart/form-data  an image file field and an area field
+# The response body is the approximated contour as a JSON list, or {"error": "..."}
+# with a 400 for bad requests and a 422 for images without a contour. A JSON payload
+# can also carry a batch, {"images": [{"image": ..., "area": ...}, ...]}, which is
+# answered with {"results": [{"contour": [...]} or {"error": "..."}, ...]} in order.
 import numpy as np
 import json
 import base64
+import hashlib
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# pipeline.py, cache.py and instrument.py are bundled next to this file in the
+# deployment package, in the repository they live one directory up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cache import LRUCache  # noqa: E402
+from pipeline import CONTOUR_PARAMS, NoContourError, Scan, decode_image  # noqa: E402
+
+# Warm state, built once per container and reused by every invocation: the
+# parameters, the contours of recently seen images (RESULT_CACHE_SIZE=0 turns
+# that off), the threads for batches (OpenCV releases the GIL) and OpenCV
+# initialised on a blank image, which also builds the kernel
+PARAMS = dict(CONTOUR_PARAMS)
+RESULTS = LRUCache(int(os.environ.get('RESULT_CACHE_SIZE', 64)))
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', min(os.cpu_count() or 1, 8)))
+EXECUTOR = ThreadPoolExecutor(BATCH_WORKERS)
+Scan(image=np.full((64, 64, 3), 255, np.uint8), params=PARAMS).morphed
+
+
+def error_message(e):
+    return '{}: {}'.format(type(e).__name__, e)
 
 
 def lambda_handler(event, context):
-    payload_base64 = event['body']
-    payload = json.loads(base64.b64decode(payload_base64))
-    area = payload['area']
-    imagebase64 = payload['image']
-    image = readb64image(imagebase64)
-    approx = analyze_image(image)
+    # Malformed requests, including bodies that are not an image and an area that
+    # is not [x, y, width, height] or lies outside the image, are answered with a
+    # 400, images without a contour with a 422
+    try:
+        request = read_request(event)
+        if isinstance(request, list):
+            return {'statusCode': 200, 'body': json.dumps({'results': analyze_batch(request)})}
+        approx = cached_analysis(*request)
+    except NoContourError as e:
+        return {'statusCode': 422, 'body': json.dumps({'error': error_message(e)})}
+    except (KeyError, TypeError, ValueError) as e:
+        return {'statusCode': 400, 'body': json.dumps({'error': error_message(e)})}
 
     return {
         'statusCode': 200,
@@ -18,39 +57,88 @@ def lambda_handler(event, context):
     }
 
 
-def readb64image(uri):
-    encoded_data = uri.split(',')[1]
-    nparr = np.fromstring(base64.b64decode(encoded_data), np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    return img
+def header(event, name):
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return ''
+
+
+def event_body(event):
+    # The body as bytes, API Gateway base64 encodes binary bodies
+    body = event['body']
+    if event.get('isBase64Encoded'):
+        return base64.b64decode(body)
+    return body.encode() if isinstance(body, str) else body
+
+
+def read_request(event):
+    # (encoded image, area) from any of the supported request forms, or the
+    # payload entries of a batch
+    content_type = header(event, 'content-type')
+    if content_type.startswith('image/'):
+        query = event.get('queryStringParameters') or {}
+        return memoryview(event_body(event)), json.loads(query.get('area', 'null'))
+    if content_type.startswith('multipart/form-data'):
+        parts = multipart_parts(event_body(event), content_type)
+        area = parts.get('area')
+        return parts['image'], json.loads(bytes(area)) if area is not None else None
+    body = event_body(event)
+    # The app base64 encodes the JSON itself
+    payload = json.loads(body if body.lstrip()[:1] == b'{' else base64.b64decode(body))
+    if 'images' in payload:
+        return list(payload['images'])
+    return readb64bytes(payload['image']), payload.get('area')
+
+
+def multipart_parts(body, content_type):
+    # Field name -> memoryview of its content, the body is not copied
+    boundary = content_type.split('boundary=', 1)[1].split(';')[0].strip('"').encode()
+    delimiter = b'\r\n--' + boundary
+    view = memoryview(body)
+    parts = {}
+    start = body.find(b'--' + boundary)
+    if start < 0:
+        raise ValueError('Multipart boundary not found')
+    start += len(boundary) + 2
+    while body[start:start + 2] != b'--':
+        headers_end = body.find(b'\r\n\r\n', start)
+        end = body.find(delimiter, headers_end)
+        if headers_end < 0 or end < 0:
+            raise ValueError('Malformed multipart body')
+        headers = bytes(view[start:headers_end]).decode('utf-8', 'replace')
+        name = re.search(r'(?:^|[;\s])name="([^"]*)"', headers)
+        parts[name.group(1) if name else None] = view[headers_end + 4:end]
+        start = end + len(delimiter)
+    return parts
 
 
-def analyze_image(image):
+def readb64bytes(uri):
+    # Decoded bytes of a data URI or of plain base64
+    return base64.b64decode(uri[uri.find(',') + 1:])
 
-    # Convert to grayscale
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-    # Apply GaussianBlur to reduce noise
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+def cached_analysis(image, area=None):
+    # Contour of the encoded image, repeated images come from RESULTS
+    if RESULTS.size == 0:
+        return analyze_image(decode_image(image), area)
+    key = (hashlib.sha1(image).hexdigest(), json.dumps(area))
+    return RESULTS.get(key, lambda: analyze_image(decode_image(image), area))
 
-    # Use adaptive thresholding
-    thresh = cv2.adaptiveThreshold(
-        blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 135, 2)
 
-    # Use morphological operations to close gaps
-    kernel = np.ones((25, 25), np.uint8)
-    morphed = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
+def batch_result(entry):
+    try:
+        return {'contour': cached_analysis(readb64bytes(entry['image']), entry.get('area'))}
+    except Exception as e:
+        return {'error': error_message(e)}
 
-    # Find contours
-    contours, _ = cv2.findContours(
-        morphed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-    # Select the contour with the largest area
-    largest_contour = max(contours, key=cv2.contourArea)
+def analyze_batch(entries):
+    # One result or error per entry, in order, at most BATCH_WORKERS at a time
+    return list(EXECUTOR.map(batch_result, entries))
 
-    # Draw an approximated contour around the largest contour
-    epsilon = 0.0025 * cv2.arcLength(largest_contour, True)
-    approx = cv2.approxPolyDP(largest_contour, epsilon, True)
 
-    # Return approx points
-    return approx.tolist()
+def analyze_image(image, area=None):
+    # Return approx points, searched for inside area ([x, y, width, height] or
+    # {'x', 'y', 'width', 'height'}) and given in full image coordinates
+    return Scan(image=image, params=PARAMS, roi=area).approx.tolist()
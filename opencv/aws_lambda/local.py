@@ -0,0 +1,116 @@
+# Stand-in API Gateway events for running lambda_function locally and throughput
+# benchmarks of the request forms it accepts and of batches.
+# Usage: python local.py <image> [--requests 20] [--area JSON] [--batch-sizes 1 2 4 ...]
+import argparse
+import base64
+import json
+import os
+import time
+
+import lambda_function
+from cache import LRUCache
+
+BOUNDARY = 'foamsizer-boundary'
+
+
+def json_event(data, area=None, content_type='image/png'):
+    # The original payload: a data URI in JSON, all of it base64 encoded
+    uri = 'data:{};base64,{}'.format(content_type, base64.b64encode(data).decode())
+    body = base64.b64encode(json.dumps({'image': uri, 'area': area}).encode()).decode()
+    return {'headers': {'Content-Type': 'application/json'}, 'body': body, 'isBase64Encoded': False}
+
+
+def raw_event(data, area=None, content_type='image/png'):
+    return {'headers': {'Content-Type': content_type},
+            'queryStringParameters': {'area': json.dumps(area)},
+            'body': base64.b64encode(data).decode(), 'isBase64Encoded': True}
+
+
+def multipart_event(data, area=None, content_type='image/png'):
+    body = b''.join([
+        '--{}\r\nContent-Disposition: form-data; name="area"\r\n\r\n'.format(BOUNDARY).encode(),
+        json.dumps(area).encode(),
+        '\r\n--{}\r\nContent-Disposition: form-data; name="image"; filename="image"\r\n'
+        'Content-Type: {}\r\n\r\n'.format(BOUNDARY, content_type).encode(),
+        data,
+        '\r\n--{}--\r\n'.format(BOUNDARY).encode()])
+    return {'headers': {'Content-Type': 'multipart/form-data; boundary=' + BOUNDARY},
+            'body': base64.b64encode(body).decode(), 'isBase64Encoded': True}
+
+
+def batch_event(images, areas=None):
+    # Plain JSON body with one data URI per image
+    areas = areas or [None] * len(images)
+    entries = [{'image': 'data:image/png;base64,' + base64.b64encode(data).decode(), 'area': area}
+               for data, area in zip(images, areas)]
+    return {'headers': {'Content-Type': 'application/json'}, 'body': json.dumps({'images': entries}),
+            'isBase64Encoded': False}
+
+
+EVENTS = {'json': json_event, 'raw': raw_event, 'multipart': multipart_event}
+BATCH_SIZES = [1, 2, 4, 8, 16, 32]
+
+
+def throughput(event, requests):
+    # Images per second of lambda_handler on the same event
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = lambda_function.lambda_handler(event, None)
+        if response['statusCode'] != 200:
+            raise RuntimeError(response['body'])
+    return requests / (time.perf_counter() - start)
+
+
+def batch_throughput(data, sizes=BATCH_SIZES, requests=3, area=None):
+    # Images per second for batches of the same image, without the result cache
+    report = []
+    results = lambda_function.RESULTS
+    lambda_function.RESULTS = LRUCache(0)
+    try:
+        for size in sizes:
+            event = batch_event([data] * size, [area] * size)
+            start = time.perf_counter()
+            for _ in range(requests):
+                body = json.loads(lambda_function.lambda_handler(event, None)['body'])
+                errors = [result['error'] for result in body['results'] if 'error' in result]
+                if errors:
+                    raise RuntimeError(errors[0])
+            report.append({'batch': size, 'workers': lambda_function.BATCH_WORKERS,
+                           'images_per_second': size * requests / (time.perf_counter() - start)})
+    finally:
+        lambda_function.RESULTS = results
+    return report
+
+
+def benchmark(data, requests, area=None):
+    report = []
+    results = lambda_function.RESULTS
+    try:
+        for form, make_event in EVENTS.items():
+            event = make_event(data, area)
+            for cache_size in [0, results.size]:
+                lambda_function.RESULTS = LRUCache(cache_size)
+                report.append({'form': form, 'cache': cache_size > 0, 'event_bytes': len(event['body']),
+                               'images_per_second': throughput(event, requests)})
+    finally:
+        lambda_function.RESULTS = results
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run lambda_function on local events')
+    parser.add_argument('image')
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--area', type=json.loads, default=None)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', metavar='SIZE',
+                        help='measure batches of these sizes instead of the request forms')
+    args = parser.parse_args()
+    with open(args.image, 'rb') as file:
+        data = file.read()
+    print('{} bytes, {}'.format(len(data), os.path.basename(args.image)))
+    if args.batch_sizes:
+        for result in batch_throughput(data, args.batch_sizes, area=args.area):
+            print('batch {batch:>3} workers {workers} {images_per_second:9.1f} images/s'.format(**result))
+        raise SystemExit
+    for result in benchmark(data, args.requests, args.area):
+        print('{form:<10} cache={cache!s:<5} {event_bytes:>9} bytes {images_per_second:9.1f} images/s'.format(**result))
@@ -0,0 +1,205 @@
+# Caches shared by the opencv scripts. LRUCache keeps results in memory for the
+# long-lived processes: the worker, the lambda and the contour fitting. DiskCache
+# keeps them between runs, keyed by the input bytes, the parameters and the source
+# of the code that computed them. It is off unless enabled with:
+#   FOAMSIZER_CACHE=1            cache in ~/.cache/foamsizer
+#   FOAMSIZER_CACHE=/some/dir    cache in /some/dir
+#   FOAMSIZER_CACHE_MB=256       size bound, least recently used entries go first
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+
+class LRUCache:
+    # Keeps the size most recently used values, a size of 0 keeps nothing. Safe to
+    # share between threads, values are computed outside the lock
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        value = compute()
+        if self.size > 0:
+            with self.lock:
+                self.entries[key] = value
+                if len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DiskCache:
+    # One file per entry named by the key: .npy for numpy arrays, .bin for bytes
+    # and .json for everything else. Entries are written to a temporary file and
+    # renamed into place, so other processes never read half an entry. Reads mark
+    # an entry as used, writes past max_bytes remove the least recently used ones.
+    # The cache is best effort: an entry that cannot be written (disk full, file
+    # locked by another process) is reported on stderr and the value still returned.
+    FORMATS = ('.npy', '.bin', '.json')
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def load(self, key):
+        for extension in self.FORMATS:
+            path = self.path(key, extension)
+            try:
+                if extension == '.npy':
+                    value = np.load(path, allow_pickle=False)
+                else:
+                    with open(path, 'rb') as file:
+                        value = file.read()
+                    if extension == '.json':
+                        value = json.loads(value)
+            except (OSError, ValueError):
+                continue
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return value
+        raise KeyError(key)
+
+    def store(self, key, value):
+        if isinstance(value, np.ndarray):
+            extension = '.npy'
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            extension = '.bin'
+        else:
+            extension = '.json'
+        file = None
+        try:
+            file = tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False)
+            with file:
+                if extension == '.npy':
+                    np.save(file, value, allow_pickle=False)
+                elif extension == '.bin':
+                    file.write(value)
+                else:
+                    file.write(json.dumps(value).encode())
+            os.replace(file.name, self.path(key, extension))
+        except OSError as e:
+            if file is not None:
+                try:
+                    os.remove(file.name)
+                except OSError:
+                    pass
+            sys.stderr.write('Could not cache {}: {}\n'.format(key, e))
+            return False
+        self.evict()
+        return True
+
+    def get(self, key, compute):
+        try:
+            return self.load(key)
+        except KeyError:
+            pass
+        value = compute()
+        self.store(key, value)
+        return value
+
+    def entries(self):
+        # (last use, size, path) of every entry, oldest first
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(self.FORMATS):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Open in another process on Windows, it goes on a later write
+                continue
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def environment_cache():
+    # The DiskCache FOAMSIZER_CACHE asks for, None without one
+    setting = os.environ.get('FOAMSIZER_CACHE', '')
+    if setting in ('', '0'):
+        return None
+    directory = os.path.join(os.path.expanduser('~'), '.cache', 'foamsizer') if setting == '1' else setting
+    return DiskCache(directory, int(float(os.environ.get('FOAMSIZER_CACHE_MB', 256)) * 2**20))
+
+
+DISK = environment_cache()
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def source_version(*paths):
+    # Changes whenever one of the source files does, so results of older code are
+    # not reused
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def cache_key(*parts):
+    # Key of JSON-able parts such as digests, names and parameters
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def cached_result(name, digest, params, sources, compute):
+    # compute(), or its result from an earlier run on input with this digest, with
+    # the same params and the same source files
+    if DISK is None:
+        return compute()
+    return DISK.get(cache_key(name, digest, params, source_version(*sources)), compute)
+
+
+def cached_file_result(name, path, params, sources, compute):
+    # cached_result for the content of the file at path, only read when caching
+    if DISK is None:
+        return compute()
+    return cached_result(name, file_digest(path), params, sources, compute)
@@ -0,0 +1,128 @@
+# Scale and perspective from printed ArUco markers of a known size, so a phone
+# photo of a tool next to the markers can be measured like a flatbed scan.
+# Markers are found on a downscaled copy and their corners refined on the full
+# resolution image. The result maps image pixels to mm on the marker plane:
+#   mm_per_pixel  marker side in mm over the mean marker side in pixels
+#   homography    3x3 image -> mm transform, origin at the top left corner of the
+#                 reference marker, or of the layout when marker positions are known
+# Calibrations are kept per camera setup, a fixed camera and marker sheet only
+# needs to be calibrated once.
+#   python calibration.py <image> <marker_mm> [--layout layout.json] [--draw out.png]
+import argparse
+import cv2
+import json
+import numpy as np
+from functools import lru_cache
+
+from cache import LRUCache
+from instrument import timed
+from pipeline import read_image
+
+DICTIONARY = cv2.aruco.DICT_ARUCO_ORIGINAL
+# Long side of the image the markers are searched on
+DETECTION_SIZE = 800
+CALIBRATIONS = LRUCache(16)
+
+
+@lru_cache(maxsize=None)
+def detector(dictionary=DICTIONARY):
+    # Building the detector loads the dictionary, it is shared between calls
+    return cv2.aruco.ArucoDetector(cv2.aruco.getPredefinedDictionary(dictionary),
+                                   cv2.aruco.DetectorParameters())
+
+
+@timed()
+def detect_markers(gray, detection_size=DETECTION_SIZE, dictionary=DICTIONARY):
+    # Marker id -> corners (top left, top right, bottom right, bottom left) as a
+    # 4x2 float32 array in full resolution coordinates
+    scale = min(1, detection_size / max(gray.shape))
+    small = gray if scale == 1 else cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    corners, ids, _ = detector(dictionary).detectMarkers(small)
+    if ids is None:
+        return {}
+    corners = (np.concatenate(corners).reshape(-1, 2) + 0.5) / scale - 0.5
+    # Search window of the refinement: the error of the downscaled corner plus a
+    # margin, but well inside the smallest marker
+    side = min(cv2.arcLength(corners[i:i + 4], True) / 4 for i in range(0, len(corners), 4))
+    window = int(min(np.ceil(1 / scale) + 3, side / 4))
+    if window >= 2:
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 40, 0.01)
+        corners = cv2.cornerSubPix(gray, np.ascontiguousarray(corners, np.float32),
+                                   (window, window), (-1, -1), criteria)
+    corners = corners.astype(np.float32).reshape(-1, 4, 2)
+    return {int(marker): marker_corners for marker, marker_corners in zip(ids.ravel(), corners)}
+
+
+def marker_square(marker_mm, x=0, y=0):
+    # Corners of a marker in mm, in the order detectMarkers returns them
+    return np.array([[x, y], [x + marker_mm, y], [x + marker_mm, y + marker_mm], [x, y + marker_mm]],
+                    np.float32)
+
+
+@timed()
+def calibrate(image, marker_mm, layout=None, detection_size=DETECTION_SIZE, dictionary=DICTIONARY):
+    # layout optionally gives the top left corner in mm of every marker id, the
+    # homography is then fitted to all markers found, otherwise it comes from the
+    # largest marker on its own
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    markers = detect_markers(gray, detection_size, dictionary)
+    if layout:
+        markers = {marker: corners for marker, corners in markers.items() if str(marker) in layout}
+    if not markers:
+        raise ValueError('No calibration markers found')
+    sides = np.concatenate([np.linalg.norm(corners - np.roll(corners, -1, axis=0), axis=1)
+                            for corners in markers.values()])
+    if layout:
+        source = np.concatenate(list(markers.values()))
+        target = np.concatenate([marker_square(marker_mm, *layout[str(marker)]) for marker in markers])
+        homography = cv2.findHomography(source, target)[0] if len(markers) > 1 \
+            else cv2.getPerspectiveTransform(source, target)
+    else:
+        reference = max(markers, key=lambda marker: cv2.contourArea(markers[marker]))
+        homography = cv2.getPerspectiveTransform(markers[reference], marker_square(marker_mm))
+    return {'mm_per_pixel': float(marker_mm / sides.mean()),
+            'homography': homography.tolist(),
+            'markers': sorted(markers)}
+
+
+def setup_calibration(setup, image, marker_mm, layout=None):
+    # Calibration of a camera setup, computed from image the first time the setup
+    # is seen with this image size and marker sheet
+    key = (setup, image.shape[:2], marker_mm, json.dumps(layout, sort_keys=True))
+    return CALIBRATIONS.get(key, lambda: calibrate(image, marker_mm, layout))
+
+
+def to_mm(points, calibration):
+    # Image points as [x, y] pairs -> positions in mm on the marker plane
+    points = np.asarray(points, np.float64).reshape(-1, 1, 2)
+    homography = np.asarray(calibration['homography'])
+    return cv2.perspectiveTransform(points, homography).reshape(-1, 2).tolist()
+
+
+def draw_markers(image, calibration, detection_size=DETECTION_SIZE, dictionary=DICTIONARY):
+    # Copy of image with the refined marker outlines and ids
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    markers = detect_markers(gray, detection_size, dictionary)
+    ids = [marker for marker in calibration['markers'] if marker in markers]
+    output = image.copy()
+    cv2.aruco.drawDetectedMarkers(output, [markers[marker].reshape(1, 4, 2) for marker in ids],
+                                  np.array(ids).reshape(-1, 1))
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='mm per pixel and homography from ArUco markers')
+    parser.add_argument('image')
+    parser.add_argument('marker_mm', type=float, help='printed side length of the markers')
+    parser.add_argument('--layout', help='JSON file with the top left corner in mm of every marker id')
+    parser.add_argument('--draw', metavar='PATH', help='write the image with the detected markers')
+    args = parser.parse_args()
+    layout = None
+    if args.layout:
+        with open(args.layout) as file:
+            layout = json.load(file)
+    image = read_image(args.image)
+    calibration = calibrate(image, args.marker_mm, layout)
+    if args.draw:
+        cv2.imwrite(args.draw, draw_markers(image, calibration))
+    print(json.dumps(calibration, indent=2))
@@ -0,0 +1,179 @@
+# Opt-in per-stage timing for the opencv scripts and the contour fitting. While
+# disabled, stage() hands out a shared no-op context and @timed calls straight
+# through after one flag check. Enable it with environment variables or enable():
+#   FOAMSIZER_PROFILE=1           JSON report of wall and CPU time per stage on
+#                                 stderr when the process exits
+#   FOAMSIZER_PROFILE=report.json write the report to report.json instead
+#   FOAMSIZER_PROFILE_MEMORY=1    also the peak memory traced by tracemalloc per
+#                                 stage, which makes python code and imports slower
+#   FOAMSIZER_CPROFILE=run.prof   also dump a cProfile of the run to run.prof
+#   FOAMSIZER_PROFILE_RECORDS=N   keep only the last N stage records (10000), so
+#                                 long-lived processes like the worker stay bounded
+import atexit
+import collections
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+enabled = False
+records = collections.deque(maxlen=int(os.environ.get('FOAMSIZER_PROFILE_RECORDS', 10000)))
+# Open stages of every thread, each as [name, wall start, cpu start, peak, wall and
+# cpu time of the finished children]
+_local = threading.local()
+_output = None
+_profiler = None
+_cprofile_path = None
+_disabled = contextlib.nullcontext()
+
+
+def enable(output='-', cprofile_path=None, memory=False):
+    # Starts recording; the report goes to output ('-' for stderr) at exit
+    global enabled, _output, _profiler, _cprofile_path
+    if not enabled:
+        atexit.register(write_report)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    enabled = True
+    _output = output
+    if cprofile_path and _profiler is None:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+        _cprofile_path = cprofile_path
+
+
+def _traced_peak():
+    if not tracemalloc.is_tracing():
+        return None
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    return peak
+
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+@contextlib.contextmanager
+def _record(name):
+    # The traced peak is reset when a stage starts, so an enclosing stage keeps
+    # the peaks of its finished children next to its own
+    _stack = _local.__dict__.setdefault('stack', [])
+    if _stack:
+        _stack[-1][3] = _max(_stack[-1][3], _traced_peak())
+    else:
+        _traced_peak()
+    entry = [name, time.perf_counter(), time.process_time(), None, 0.0, 0.0]
+    _stack.append(entry)
+    try:
+        yield
+    finally:
+        _stack.pop()
+        peak = _max(entry[3], _traced_peak())
+        wall = time.perf_counter() - entry[1]
+        cpu = time.process_time() - entry[2]
+        # self_ times leave out the stages that ran inside this one
+        records.append({'stage': name, 'depth': len(_stack), 'wall': wall, 'cpu': cpu,
+                        'self_wall': wall - entry[4], 'self_cpu': cpu - entry[5], 'peak_bytes': peak})
+        if _stack:
+            parent = _stack[-1]
+            parent[3] = _max(parent[3], peak)
+            parent[4] += wall
+            parent[5] += cpu
+
+
+def stage(name):
+    return _record(name) if enabled else _disabled
+
+
+def timed(name=None):
+    # Decorator recording every call of the function as a stage
+    def decorator(function):
+        # Named after the file, so scripts run as __main__ get the same names
+        module = os.path.splitext(os.path.basename(function.__code__.co_filename))[0]
+        label = name or '{}.{}'.format(module, function.__qualname__)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _record(label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    # Calls, total seconds and the largest peak per stage name
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['stage'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'self_wall': 0.0,
+                                                    'self_cpu': 0.0, 'peak_bytes': None})
+        total['calls'] += 1
+        for key in ['wall', 'cpu', 'self_wall', 'self_cpu']:
+            total[key] += record[key]
+        total['peak_bytes'] = _max(total['peak_bytes'], record['peak_bytes'])
+    return totals
+
+
+def reset():
+    records.clear()
+
+
+def _windows_peak_bytes():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+            [(field, ctypes.c_size_t) for field in [
+                'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage']]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    current_process = ctypes.windll.kernel32.GetCurrentProcess
+    current_process.restype = wintypes.HANDLE
+    memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+    memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+    if not memory_info(current_process(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+def max_rss_kb():
+    # Peak resident memory of the process in KiB: ru_maxrss, which macOS gives in
+    # bytes and Linux in KiB, and the peak working set on Windows
+    if sys.platform == 'win32':
+        peak = _windows_peak_bytes()
+        return None if peak is None else peak // 1024
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def report():
+    return {'pid': os.getpid(), 'argv': sys.argv, 'max_rss_kb': max_rss_kb(),
+            'summary': summary(), 'stages': list(records)}
+
+
+def write_report():
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_cprofile_path)
+    text = json.dumps(report(), indent=1)
+    if _output in (None, '-', '1'):
+        sys.stderr.write(text + '\n')
+    else:
+        with open(_output, 'w') as file:
+            file.write(text)
+
+
+if os.environ.get('FOAMSIZER_PROFILE') or os.environ.get('FOAMSIZER_CPROFILE'):
+    enable(os.environ.get('FOAMSIZER_PROFILE') or '-', os.environ.get('FOAMSIZER_CPROFILE'),
+           bool(os.environ.get('FOAMSIZER_PROFILE_MEMORY')))
@@ -0,0 +1,473 @@
+# Shared image analysis pipeline used by test.py, remove_bg.py and the aws lambda.
+# Every stage is computed on first access and kept, so one decode and one morphology
+# pass can give both the approximated contour and the background-removed image.
+import argparse
+import cv2
+import json
+import numpy as np
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
+from instrument import stage, timed
+
+# Adaptive threshold pipeline used to find the tool contour
+CONTOUR_PARAMS = {
+    'blur': 5,
+    'threshold': 'adaptive',
+    'block_size': 135,
+    'c': 2,
+    'kernel': 25,
+    'kernel_shape': cv2.MORPH_RECT,
+    'epsilon': 0.0025,
+    # Threshold and close on a copy resized by this factor, kernel sizes scale along
+    'scale': 1,
+}
+
+# Fixed threshold on the white scanner background used to cut out the tool
+BACKGROUND_PARAMS = {
+    'blur': 0,
+    'threshold': 240,
+    'kernel': 11,
+    'kernel_shape': cv2.MORPH_ELLIPSE,
+    'epsilon': 0.0025,
+    'scale': 1,
+}
+
+# Scanner resolution, used to report distances in mm
+DPI = 300
+# The app divides image points by this for contour.txt
+PIXELS_PER_UNIT = 1.1811
+
+# Tool-sized objects cover between these fractions of the searched area
+MIN_TOOL_AREA = 0.002
+MAX_TOOL_AREA = 0.9
+
+# Scan stages in the order they are computed
+STAGES = ['image', 'gray', 'work', 'blurred', 'thresh', 'morphed', 'contours', 'largest_contour', 'approx']
+
+
+class NoContourError(ValueError):
+    # The image decoded fine but nothing in it stands out from the background
+    pass
+
+
+def read_image(path):
+    image = cv2.imread(path)
+    if image is None:
+        raise FileNotFoundError('Could not read image ' + path)
+    return image
+
+
+def decode_image(data):
+    # Decodes encoded image bytes (png, jpeg, ...) without copying them
+    if not len(data):
+        raise ValueError('Empty image')
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Could not decode image')
+    return image
+
+
+def scaled_size(size, scale, minimum=1):
+    # Odd kernel size for the working resolution
+    size = max(int(round(size * scale)), minimum)
+    return size if size % 2 == 1 else size + 1
+
+
+@lru_cache(maxsize=None)
+def structuring_element(shape, size):
+    # Kernels are shared between scans, they are only read
+    return cv2.getStructuringElement(shape, (size, size))
+
+
+def region_bounds(area, shape):
+    # Clipped (x, y, width, height) of an area given as [x, y, width, height] or as
+    # {'x', 'y', 'width', 'height'}, the whole image without one
+    height, width = shape[:2]
+    if not area:
+        return 0, 0, width, height
+    if isinstance(area, dict):
+        area = [area['x'], area['y'], area['width'], area['height']]
+    if not isinstance(area, (list, tuple)) or len(area) != 4 or \
+            not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in area):
+        raise ValueError('Area must be [x, y, width, height], got {!r}'.format(area))
+    x, y, w, h = (int(round(value)) for value in area)
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + w, width), min(y + h, height)
+    if right <= left or bottom <= top:
+        raise ValueError('Area {} is outside the image'.format(area))
+    return left, top, right - left, bottom - top
+
+
+def refine_contour(gray, contour, search, threshold, blur=0):
+    # Moves each point along its normal to the nearest position within +-search
+    # full resolution pixels where the thresholded image changes, so a contour
+    # traced on a downscaled copy lands on the full resolution outline. The gray
+    # values get the blur x blur Gaussian of the full resolution scan, applied
+    # along and across the normal. threshold(x, y) gives the threshold at full
+    # resolution positions, values at or below it are foreground as with
+    # THRESH_BINARY_INV, and the point ends on the last foreground pixel like the
+    # contours of findContours do.
+    points = contour.reshape(-1, 2).astype(np.float32)
+    tangent = np.roll(points, -1, axis=0) - np.roll(points, 1, axis=0)
+    length = np.hypot(tangent[:, 0], tangent[:, 1])
+    length[length == 0] = 1
+    tangent /= length[:, None]
+    normal = np.stack([-tangent[:, 1], tangent[:, 0]], axis=1)
+    half = blur // 2
+    steps = np.arange(-search - half, search + half + 1, dtype=np.float32)
+    across = np.arange(-half, half + 1, dtype=np.float32)[:, None]
+    # Samples per point, across the normal and along it
+    map_x = points[:, 0, None, None] + normal[:, 0, None, None] * steps + tangent[:, 0, None, None] * across
+    map_y = points[:, 1, None, None] + normal[:, 1, None, None] * steps + tangent[:, 1, None, None] * across
+    count = len(points)
+    samples = cv2.remap(gray, map_x.reshape(count, -1), map_y.reshape(count, -1), cv2.INTER_LINEAR,
+                        borderMode=cv2.BORDER_REPLICATE).reshape(map_x.shape).astype(np.float32)
+    profiles = samples[:, 0]
+    if half:
+        taps = cv2.getGaussianKernel(2 * half + 1, 0).ravel().astype(np.float32)
+        across_blurred = np.tensordot(samples, taps, axes=([1], [0]))
+        profiles = sum(tap * across_blurred[:, i:i + 2 * search + 1] for i, tap in enumerate(taps))
+    inner = slice(half, half + 2 * search + 1)
+    foreground = profiles <= threshold(map_x[:, half, inner], map_y[:, half, inner])
+    # Foreground side of every change between neighbouring samples, the one
+    # nearest to the point wins
+    changes = foreground[:, 1:] != foreground[:, :-1]
+    positions = np.arange(2 * search)
+    positions = np.where(foreground[:, 1:], positions + 1, positions)
+    nearest = np.argmin(np.where(changes, np.abs(positions - search), 4 * search), axis=1)
+    rows = np.arange(count)
+    shift = np.where(changes[rows, nearest], positions[rows, nearest] - search, 0)
+    refined = np.round(points + normal * shift[:, None])
+    refined = np.clip(refined, 0, [gray.shape[1] - 1, gray.shape[0] - 1])
+    return refined.astype(np.int32).reshape(-1, 1, 2)
+
+
+def contour_distances(reference, contour, dpi=DPI):
+    # Distances in mm from every point of contour to the reference outline
+    reference = reference.reshape(-1, 1, 2).astype(np.float32)
+    distances = [abs(cv2.pointPolygonTest(reference, (float(x), float(y)), True))
+                 for x, y in contour.reshape(-1, 2)]
+    return np.array(distances) * 25.4 / dpi
+
+
+class Scan:
+    # roi limits the contour search to an area of the image (see region_bounds),
+    # the contours are still in full image coordinates
+    def __init__(self, image=None, path=None, params=CONTOUR_PARAMS, roi=None):
+        if image is None and path is None:
+            raise ValueError('Scan needs an image or a path')
+        self.path = path
+        self.params = params
+        self.roi = roi
+        if image is not None:
+            self.image = image
+
+    @cached_property
+    @timed('scan.image')
+    def image(self):
+        return read_image(self.path)
+
+    @cached_property
+    @timed('scan.gray')
+    def gray(self):
+        # Images read with IMREAD_GRAYSCALE are used as they are
+        if self.image.ndim == 2:
+            return self.image
+        return cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+
+    @property
+    def scale(self):
+        return self.params.get('scale', 1)
+
+    @cached_property
+    def bounds(self):
+        return region_bounds(self.roi, self.gray.shape)
+
+    @cached_property
+    @timed('scan.work')
+    def work(self):
+        # Grayscale region of interest at the resolution thresholding and morphology run on
+        x, y, width, height = self.bounds
+        region = self.gray[y:y + height, x:x + width]
+        if self.scale == 1:
+            return region
+        size = (max(int(width * self.scale), 1), max(int(height * self.scale), 1))
+        return cv2.resize(region, size, interpolation=cv2.INTER_AREA)
+
+    @cached_property
+    @timed('scan.blurred')
+    def blurred(self):
+        # Apply GaussianBlur to reduce noise
+        size = self.params['blur']
+        if not size:
+            return self.work
+        size = scaled_size(size, self.scale)
+        return cv2.GaussianBlur(self.work, (size, size), 0)
+
+    @cached_property
+    @timed('scan.thresh')
+    def thresh(self):
+        if self.params['threshold'] == 'adaptive':
+            return cv2.adaptiveThreshold(
+                self.blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV,
+                scaled_size(self.params['block_size'], self.scale, 3), self.params['c'])
+        _, thresh = cv2.threshold(
+            self.blurred, self.params['threshold'], 255, cv2.THRESH_BINARY_INV)
+        return thresh
+
+    @cached_property
+    def kernel(self):
+        # Rounded up, a smaller kernel leaves gaps open that close at full resolution
+        size = max(int(np.ceil(round(self.params['kernel'] * self.scale, 6))), 1)
+        return structuring_element(self.params['kernel_shape'], size)
+
+    @cached_property
+    @timed('scan.morphed')
+    def morphed(self):
+        # Use morphological operations to close gaps
+        return cv2.morphologyEx(self.thresh, cv2.MORPH_CLOSE, self.kernel)
+
+    @cached_property
+    @timed('scan.contours')
+    def contours(self):
+        # Contours in full resolution coordinates
+        contours, _ = cv2.findContours(
+            self.morphed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return tuple(self.full_resolution(contour) for contour in contours)
+
+    def full_resolution(self, contour):
+        # Contour of the work image in full image coordinates
+        if self.scale != 1:
+            contour = np.round((contour + 0.5) / self.scale - 0.5).astype(np.int32)
+        x, y = self.bounds[:2]
+        if x or y:
+            contour = contour + np.array([x, y], np.int32)
+        return contour
+
+    @cached_property
+    def local_means(self):
+        # Gaussian weighted means adaptiveThreshold compares the work image with
+        size = scaled_size(self.params['block_size'], self.scale, 3)
+        return cv2.GaussianBlur(self.blurred.astype(np.float32), (size, size), 0,
+                                borderType=cv2.BORDER_REPLICATE)
+
+    def threshold_levels(self, x, y):
+        # Threshold of thresh at full resolution positions
+        if self.params['threshold'] != 'adaptive':
+            return np.full(x.shape, self.params['threshold'], np.float32)
+        left, top = self.bounds[:2]
+        return cv2.remap(self.local_means, (x - left + 0.5) * self.scale - 0.5, (y - top + 0.5) * self.scale - 0.5,
+                         cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE) - self.params['c']
+
+    def refined(self, contour):
+        if self.scale == 1:
+            return contour
+        # Snap the upscaled points back onto the full resolution outline
+        blur = scaled_size(self.params['blur'], 1) if self.params['blur'] else 0
+        return refine_contour(self.gray, contour, int(np.ceil(1 / self.scale)) + 1, self.threshold_levels, blur)
+
+    @cached_property
+    @timed('scan.largest_contour')
+    def largest_contour(self):
+        # Select the contour with the largest area
+        if len(self.contours) == 0:
+            raise NoContourError('No contour found')
+        return self.refined(max(self.contours, key=cv2.contourArea))
+
+    def approximate(self, contour):
+        epsilon = self.params['epsilon'] * cv2.arcLength(contour, True)
+        return cv2.approxPolyDP(contour, epsilon, True)
+
+    @cached_property
+    @timed('scan.approx')
+    def approx(self):
+        # Approximated contour around the largest contour
+        return self.approximate(self.largest_contour)
+
+    @cached_property
+    def points(self):
+        # Approximated contour points as [x, y] pairs
+        return [point[0] for point in self.approx.tolist()]
+
+    def candidates(self, count):
+        # The count largest contours, approximated, with their areas
+        contours = sorted(self.contours, key=cv2.contourArea, reverse=True)[:count]
+        return [{'contour': [point[0] for point in self.approximate(contour).tolist()],
+                 'area': float(cv2.contourArea(contour))} for contour in contours]
+
+    @cached_property
+    @timed('scan.components')
+    def components(self):
+        # Label count, labels, stats and centroids of the closed threshold image
+        return cv2.connectedComponentsWithStats(self.morphed, connectivity=8)
+
+    def component_contour(self, label):
+        # Outer contour of one labelled component, traced inside its bounding box only
+        _, labels, stats, _ = self.components
+        x, y, width, height = stats[label, :4]
+        mask = (labels[y:y + height, x:x + width] == label).astype(np.uint8)
+        # findContours ignores the outermost pixels of its image
+        mask = cv2.copyMakeBorder(mask, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                       offset=(int(x) - 1, int(y) - 1))
+        return self.refined(self.full_resolution(max(contours, key=cv2.contourArea)))
+
+    @timed('scan.tools')
+    def tool_labels(self, min_area=MIN_TOOL_AREA, max_area=MAX_TOOL_AREA):
+        # Labels of the components covering min_area to max_area of the searched
+        # area, largest first, as (inside, touching the edge)
+        count, _, stats, _ = self.components
+        height, width = self.morphed.shape
+        inside, edge = [], []
+        for label in sorted(range(1, count), key=lambda label: stats[label, cv2.CC_STAT_AREA], reverse=True):
+            x, y, w, h, area = stats[label]
+            if min_area * width * height <= area <= max_area * width * height:
+                touching = x == 0 or y == 0 or x + w == width or y + h == height
+                (edge if touching else inside).append(label)
+        return inside, edge
+
+    def tools(self, min_area=MIN_TOOL_AREA, max_area=MAX_TOOL_AREA, border=False, workers=None):
+        # Contours of every tool-sized object, largest first. Unless border is set,
+        # objects touching the edge of the searched area (background and shadows) are
+        # left out. The contours are traced in parallel and objects inside another
+        # tool are dropped.
+        inside, edge = self.tool_labels(min_area, max_area)
+        labels = inside
+        if border:
+            stats = self.components[2]
+            labels = sorted(inside + edge, key=lambda label: stats[label, cv2.CC_STAT_AREA], reverse=True)
+        with ThreadPoolExecutor(workers) as executor:
+            contours = list(executor.map(self.component_contour, labels))
+        tools = []
+        for contour in contours:
+            point = tuple(float(value) for value in contour[0, 0])
+            if all(cv2.pointPolygonTest(tool, point, False) < 0 for tool in tools):
+                tools.append(contour)
+        return tools
+
+    @cached_property
+    @timed('scan.mask')
+    def mask(self):
+        mask = np.zeros(self.image.shape[:2], np.uint8)
+        cv2.drawContours(mask, [self.largest_contour], -1, 255, -1)
+        return mask
+
+    @cached_property
+    @timed('scan.transparent')
+    def transparent(self):
+        # BGRA image with everything outside the largest contour transparent
+        image = self.image
+        if image.shape[2] < 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+        return cv2.bitwise_and(image, image, mask=self.mask)
+
+
+def stage_timings(scan, stages=STAGES):
+    # Computes the stages one after the other and returns the seconds each one took
+    timings = {}
+    for name in stages:
+        start = time.perf_counter()
+        getattr(scan, name)
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+@timed()
+def analyze_and_remove_background(input_path, output_path):
+    # Contour points and the png remove_bg.py writes, from one read of the scan: the
+    # background mask uses BACKGROUND_PARAMS on the same image and grayscale copy
+    scan = Scan(path=input_path)
+    background = Scan(image=scan.image, params=BACKGROUND_PARAMS)
+    background.gray = scan.gray
+    transparent = background.transparent
+    with stage('imwrite'):
+        cv2.imwrite(output_path, transparent)
+    return scan.points
+
+
+def write_tool(image, contour, directory, margin=20):
+    # A tool folder like the app makes for one scan: main.png cropped around the
+    # tool and contour.txt relative to the crop, in the app's units
+    x, y, width, height = cv2.boundingRect(contour)
+    left, top = max(x - margin, 0), max(y - margin, 0)
+    right = min(x + width + margin, image.shape[1])
+    bottom = min(y + height + margin, image.shape[0])
+    os.makedirs(directory, exist_ok=True)
+    with stage('imwrite'):
+        cv2.imwrite(os.path.join(directory, 'main.png'), image[top:bottom, left:right])
+    points = (contour.reshape(-1, 2) - [left, top]) / PIXELS_PER_UNIT
+    with open(os.path.join(directory, 'contour.txt'), 'w') as file:
+        file.writelines('{},{}\n'.format(x, y) for x, y in points.tolist())
+    return {'path': directory, 'bounds': [left, top, right - left, bottom - top],
+            'contour': contour.reshape(-1, 2).tolist(), 'area': float(cv2.contourArea(contour))}
+
+
+@timed()
+def split_tools(input_path, output_dir, params=CONTOUR_PARAMS, min_area=MIN_TOOL_AREA, workers=None,
+                border=False, fit=None):
+    # One folder per tool found in the scan, tool_1 the largest; the tools are
+    # approximated, cropped and written in parallel. fit(directory) runs on every
+    # tool folder once it is written, in the same threads, for example
+    # fitting.run with an offset to add curves.json. Objects touching the image
+    # edge are only kept with border, otherwise they are reported on stderr.
+    scan = Scan(path=input_path, params=params)
+    tools = scan.tools(min_area, border=border, workers=workers)
+    if not border:
+        edge = scan.tool_labels(min_area)[1]
+        if edge:
+            sys.stderr.write('{}: skipped {} tool-sized object(s) touching the image edge, '
+                             'keep them with border=True\n'.format(input_path, len(edge)))
+
+    def write(number, contour):
+        tool = write_tool(scan.image, scan.approximate(contour),
+                          os.path.join(output_dir, 'tool_{}'.format(number)))
+        if fit is not None:
+            with stage('fit'):
+                fit(tool['path'])
+        return tool
+
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(write, range(1, len(tools) + 1), tools))
+
+
+def downscale_accuracy(path, scales, params=CONTOUR_PARAMS, dpi=DPI):
+    # Time and distance in mm of the downscaled contours against the full resolution one
+    image = read_image(path)
+    start = time.perf_counter()
+    reference = Scan(image=image, params=params).largest_contour
+    report = [{'scale': 1, 'seconds': time.perf_counter() - start, 'mean_mm': 0.0, 'max_mm': 0.0}]
+    for scale in scales:
+        start = time.perf_counter()
+        scan = Scan(image=image, params=dict(params, scale=scale))
+        contour = scan.largest_contour
+        seconds = time.perf_counter() - start
+        entry = {'scale': scale, 'seconds': seconds}
+        # The upscaled contour without the full resolution refinement for comparison
+        unrefined = max(scan.contours, key=cv2.contourArea)
+        for prefix, compared in [('', contour), ('unrefined_', unrefined)]:
+            # Both directions, so missing parts of either outline show up
+            distances = np.concatenate([contour_distances(reference, compared, dpi),
+                                        contour_distances(compared, reference, dpi)])
+            entry.update({prefix + 'mean_mm': float(distances.mean()), prefix + 'max_mm': float(distances.max())})
+        report.append(entry)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Contour points and background-removed png of a scan')
+    parser.add_argument('image')
+    parser.add_argument('output', nargs='?', help='path of the transparent png, needed without --accuracy')
+    parser.add_argument('--accuracy', type=float, nargs='+', metavar='SCALE',
+                        help='report the accuracy loss of these scale factors instead')
+    args = parser.parse_args()
+    if not args.accuracy and not args.output:
+        parser.error('output is required without --accuracy')
+    if args.accuracy:
+        print(json.dumps(downscale_accuracy(args.image, args.accuracy), indent=2))
+    else:
+        points = analyze_and_remove_background(args.image, args.output)
+        print(json.dumps(points))
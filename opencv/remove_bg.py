@@ -1,39 +1,103 @@
-# Reads a base64 image and removes the background
+# Reads an image and removes the background
+#   python remove_bg.py <input> <output> [--low-memory] [--crop]
+#   python remove_bg.py <input> <output> --compare-memory   peak RSS of every mode
+import argparse
 import cv2
-import numpy as np
+import json
+import os
+import subprocess
 import sys
+import pipeline
+from cache import cached_file_result
+from pipeline import BACKGROUND_PARAMS, Scan
+from instrument import max_rss_kb, stage, timed
 
+MODES = {'default': [], 'low_memory': ['--low-memory'], 'low_memory_crop': ['--low-memory', '--crop']}
+# Cached results are reused while these files stay the same
+SOURCES = (os.path.abspath(__file__), pipeline.__file__)
 
-def fourChannels(img):
-    height, width, channels = img.shape
-    if channels < 4:
-        new_img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-        return new_img
 
-    return img
+@timed()
+def remove_background(input_path, output_path, low_memory=False, crop=False):
+    # Make everything outside the largest contour transparent
+    data = cached_file_result('remove_background', input_path, [BACKGROUND_PARAMS, low_memory, crop], SOURCES,
+                              lambda: transparent_png(input_path, low_memory, crop))
 
+    # Save the result as png with transparent background
+    with stage('imwrite'):
+        with open(output_path, 'wb') as file:
+            file.write(data)
 
-if __name__ == '__main__':
-    # Read the image
-    input_path = sys.argv[1]
-    output_path = sys.argv[2]
-    img = cv2.imread(input_path)
-    img = fourChannels(img)
 
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    th, threshed = cv2.threshold(gray, 240, 255, cv2.THRESH_BINARY_INV)
+def transparent_png(input_path, low_memory=False, crop=False):
+    if low_memory:
+        transparent = cut_out(input_path, crop)
+    else:
+        transparent = Scan(path=input_path, params=BACKGROUND_PARAMS).transparent
+    with stage('imencode'):
+        return cv2.imencode('.png', transparent)[1].tobytes()
 
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (11, 11))
-    morphed = cv2.morphologyEx(threshed, cv2.MORPH_CLOSE, kernel)
 
-    cnts = cv2.findContours(morphed, cv2.RETR_EXTERNAL,
-                            cv2.CHAIN_APPROX_SIMPLE)[-2]
-    cnt = sorted(cnts, key=cv2.contourArea)[-1]
+@timed()
+def cut_out(input_path, crop=False):
+    # The image of Scan.transparent with fewer full size buffers: the mask comes
+    # from a grayscale read, the colour image is only read once the threshold
+    # buffers are gone and the background is cleared in place in the one BGRA
+    # buffer. With crop the result is cut to the bounding box of the contour.
+    with stage('imread'):
+        gray = cv2.imread(input_path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise FileNotFoundError('Could not read image ' + input_path)
+    contour = Scan(image=gray, params=BACKGROUND_PARAMS).largest_contour
+    if crop:
+        x, y, width, height = cv2.boundingRect(contour)
+    else:
+        x, y, (height, width) = 0, 0, gray.shape
+    # The grayscale pixels are not needed anymore, their buffer becomes the mask of
+    # the background
+    outside = gray[y:y + height, x:x + width]
+    outside[:] = 255
+    cv2.drawContours(outside, [contour], -1, 0, -1, offset=(-x, -y))
+    with stage('imread'):
+        image = cv2.imread(input_path)
+    transparent = cv2.cvtColor(image[y:y + height, x:x + width], cv2.COLOR_BGR2BGRA)
+    del image
+    # Zeroes the background pixels in place, alpha included; the tool keeps the
+    # alpha of 255 cvtColor gives it
+    cv2.subtract(transparent, transparent, dst=transparent, mask=outside)
+    return transparent
 
-    # Make background transparent
-    mask = np.zeros(img.shape[:2], np.uint8)
-    cv2.drawContours(mask, [cnt], -1, 255, -1)
-    dst = cv2.bitwise_and(img, img, mask=mask)
 
-    # Save the result as png with transparent background
-    cv2.imwrite(output_path, dst)
+def compare_memory(input_path, output_path):
+    # Peak RSS in kB of every mode, each run in a fresh process, and of a process
+    # that only imports the modules
+    peaks = {'imports': json.loads(subprocess.run(
+        [sys.executable, '-c', 'import remove_bg, json; print(json.dumps(remove_bg.max_rss_kb()))'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, check=True).stdout)}
+    for mode, flags in MODES.items():
+        result = subprocess.run([sys.executable, __file__, input_path, output_path, '--rss'] + flags,
+                                capture_output=True, check=True)
+        peaks[mode] = json.loads(result.stdout)
+    return peaks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make the background of a scan transparent')
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='mask from a grayscale read and the background cleared in place')
+    parser.add_argument('--crop', action='store_true',
+                        help='cut the output to the bounding box of the tool (with --low-memory)')
+    parser.add_argument('--rss', action='store_true', help='print the peak RSS in kB')
+    parser.add_argument('--compare-memory', action='store_true',
+                        help='print the peak RSS in kB of every mode')
+    args = parser.parse_args()
+    if args.crop and not args.low_memory:
+        parser.error('--crop needs --low-memory')
+    if args.compare_memory:
+        print(json.dumps(compare_memory(args.input, args.output), indent=2))
+    else:
+        remove_background(args.input, args.output, args.low_memory, args.crop)
+        if args.rss:
+            print(json.dumps(max_rss_kb()))
@@ -0,0 +1,199 @@
+# Timing and golden output suite for the contour fitting.
+#   python benchmark.py [--sizes 30 300 ...] [--output results.json]   time every stage
+#   python benchmark.py --compare old.json new.json                   speedup per stage
+#   python benchmark.py --update-golden                               rewrite golden.json
+#   python benchmark.py --nesting [--tools 10 50 ...]                 placements per second
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import shapely
+
+import binary_curves
+import fitting
+import nesting
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_PATH = os.path.join(DIRECTORY, 'golden.json')
+SIZES = [30, 100, 300, 1000, 3000, 20000]
+TOOL_COUNTS = [10, 50, 100, 200]
+GOLDEN_OFFSETS = [0, 20]
+# The app divides analyzed image points by this to get contour.txt coordinates
+PIXELS_PER_UNIT = 1.1811
+
+
+def circle(radius=400):
+    return shapely.geometry.Point(0, 0).buffer(radius, quad_segs=256)
+
+
+def rounded_rectangle(width=800, height=300, radius=60):
+    return shapely.geometry.box(0, 0, width, height).buffer(radius, quad_segs=64)
+
+
+def plier():
+    # Round joint, straight jaws and two slightly spread handles
+    joint = shapely.geometry.Point(0, 0).buffer(60, quad_segs=64)
+    jaws = shapely.geometry.Polygon([(-35, 0), (35, 0), (12, 260), (-12, 260)])
+    handles = [shapely.affinity.rotate(shapely.geometry.LineString([(0, 0), (0, -700)]).buffer(25, quad_segs=32),
+                                       angle, origin=(0, 0)) for angle in (-8, 8)]
+    return shapely.unary_union([joint, jaws] + handles)
+
+
+SHAPES = {'circle': circle, 'rounded_rectangle': rounded_rectangle, 'plier': plier}
+
+
+def synthetic_contour(shape, size):
+    # size points spread evenly along the outline of the shape
+    ring = SHAPES[shape]().exterior
+    distances = np.linspace(0, ring.length, size, endpoint=False)
+    return shapely.get_coordinates(shapely.line_interpolate_point(ring, distances)).tolist()
+
+
+def write_contour(path, points):
+    with open(path + '/contour.txt', 'w') as file:
+        file.writelines('{},{}\n'.format(x, y) for x, y in points)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark(shape, size, path, budget, skipped):
+    # Times every stage on its own; stages that already went over budget for a
+    # smaller contour of this shape, and the stages that depend on them, are skipped
+    write_contour(path, synthetic_contour(shape, size))
+    points, seconds = timed(fitting.get_points, path)
+    results = [{'shape': shape, 'points': size, 'stage': 'get_points', 'seconds': seconds}]
+    params = fitting.default_params(points)
+    arcs = lines = None
+    if 'find_arcs' not in skipped:
+        arcs, seconds = timed(fitting.find_arcs, points, params['arc_length_threshold'],
+                              params['arc_deviation_threshold'])
+        results.append({'shape': shape, 'points': size, 'stage': 'find_arcs', 'seconds': seconds})
+    if arcs is not None and 'find_lines' not in skipped:
+        lines, seconds = timed(fitting.find_lines, points, arcs, params['line_deviation_threshold'])
+        results.append({'shape': shape, 'points': size, 'stage': 'find_lines', 'seconds': seconds})
+    if lines is not None:
+        _, seconds = timed(fitting.lines_to_file, path, lines, arcs, points)
+        results.append({'shape': shape, 'points': size, 'stage': 'lines_to_file', 'seconds': seconds})
+        _, seconds = timed(binary_curves.write, path + '/curves.bin', *fitting.curves_tables(lines, arcs, points))
+        results.append({'shape': shape, 'points': size, 'stage': 'curves_bin', 'seconds': seconds})
+    for result in results:
+        if result['seconds'] > budget:
+            skipped.add(result['stage'])
+    return results
+
+
+def run_benchmarks(sizes, budget):
+    # Load scipy before timing anything
+    warmup = synthetic_contour('circle', 30)
+    fitting.fit_contour(warmup, fitting.default_params(warmup))
+    results = []
+    path = tempfile.mkdtemp()
+    try:
+        for shape in SHAPES:
+            skipped = set()
+            for size in sizes:
+                results.extend(benchmark(shape, size, path, budget, skipped))
+    finally:
+        shutil.rmtree(path)
+    return results
+
+
+def synthetic_tools(count, seed=0):
+    # Buffered outlines of the shapes at random tool sizes, roughly 20 to 150 mm long
+    rng = np.random.default_rng(seed)
+    names = list(SHAPES)
+    tools = []
+    for i in range(count):
+        shape = shapely.affinity.scale(SHAPES[names[i % len(names)]](), *rng.uniform(0.05, 0.12, 2), origin=(0, 0))
+        tools.append(shapely.get_coordinates(shape.buffer(2).simplify(1).exterior).tolist())
+    return tools
+
+
+def benchmark_nesting(counts, width=400):
+    # Trays three times the tool area deep, so every tool fits
+    results = []
+    for count in counts:
+        tools = synthetic_tools(count)
+        area = sum(shapely.Polygon(tool).area for tool in tools)
+        layout, seconds = timed(nesting.nest, tools, width, 3 * area / width)
+        results.append({'tools': count, 'seconds': seconds, 'placed': len(layout['placements']),
+                        'placements_per_second': len(layout['placements']) / seconds,
+                        'queries_per_second': layout['queries'] / seconds,
+                        'density': area / (width * layout['height'])})
+    return results
+
+
+def compare(old_path, new_path):
+    # Speedup of every stage that both result files contain
+    with open(old_path) as file:
+        old = {(r['shape'], r['points'], r['stage']): r['seconds'] for r in json.load(file)['results']}
+    with open(new_path) as file:
+        new = {(r['shape'], r['points'], r['stage']): r['seconds'] for r in json.load(file)['results']}
+    for key in sorted(old.keys() & new.keys()):
+        print('{:<18} {:>6} {:<14} {:9.4f}s -> {:9.4f}s  x{:.2f}'.format(
+            *key, old[key], new[key], old[key] / max(new[key], 1e-9)))
+
+
+def curves(points):
+    # curves.json content of a contour, written through lines_to_file
+    path = tempfile.mkdtemp()
+    try:
+        result = fitting.fit_contour(points, fitting.default_params(points))
+        fitting.lines_to_file(path, result['lines'], result['arcs'], points)
+        with open(path + '/curves.json') as file:
+            return json.load(file)
+    finally:
+        shutil.rmtree(path)
+
+
+def main_png_points():
+    # Contour of the bundled main.png scaled like the app writes contour.txt
+    sys.path.insert(0, os.path.dirname(DIRECTORY))
+    from pipeline import Scan
+    return [(x / PIXELS_PER_UNIT, y / PIXELS_PER_UNIT)
+            for x, y in Scan(path=os.path.join(DIRECTORY, 'main.png')).points]
+
+
+def golden_outputs():
+    outputs = {'contour_offset_{}'.format(offset): curves(fitting.get_points(DIRECTORY, offset))
+               for offset in GOLDEN_OFFSETS}
+    outputs['main_png'] = curves(main_png_points())
+    return outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Contour fitting benchmarks and golden outputs')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--budget', type=float, default=10,
+                        help='skip larger contours for a stage that took longer than this')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--update-golden', action='store_true')
+    parser.add_argument('--nesting', action='store_true', help='time the tray layout instead')
+    parser.add_argument('--tools', type=int, nargs='+', default=TOOL_COUNTS)
+    args = parser.parse_args()
+    if args.nesting:
+        for result in benchmark_nesting(args.tools):
+            print('{tools:>4} tools {seconds:8.3f}s {placements_per_second:8.1f} placements/s '
+                  '{queries_per_second:9.0f} positions/s  density {density:.2f}'.format(**result))
+    elif args.compare:
+        compare(*args.compare)
+    elif args.update_golden:
+        with open(GOLDEN_PATH, 'w') as file:
+            json.dump(golden_outputs(), file, indent=1)
+    else:
+        report = {'python': sys.version.split()[0], 'numpy': np.__version__,
+                  'results': run_benchmarks(args.sizes, args.budget)}
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(report, file, indent=1)
+        for result in report['results']:
+            print('{shape:<18} {points:>6} {stage:<14} {seconds:9.4f}s'.format(**result))
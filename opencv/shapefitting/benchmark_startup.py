@@ -0,0 +1,50 @@
+# Measures the startup cost of the headless fitting path in fresh interpreters and
+# checks which of the heavy modules each stage pulls in.
+# Usage: python benchmark_startup.py [repeats]
+import json
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ['matplotlib', 'scipy', 'shapely']
+
+# Runs inside the child interpreter, prints one JSON line
+STAGES = '''
+import json, os, sys, time
+sys.path.insert(0, {directory!r})
+heavy = {heavy!r}
+loaded = lambda: [name for name in heavy if name in sys.modules]
+stages = []
+start = time.perf_counter()
+import fitting
+stages.append({{'stage': 'import', 'seconds': time.perf_counter() - start, 'modules': loaded()}})
+start = time.perf_counter()
+points = fitting.get_points({directory!r})
+result = fitting.fit_contour(points, fitting.default_params(points))
+stages.append({{'stage': 'fit', 'seconds': time.perf_counter() - start, 'modules': loaded()}})
+start = time.perf_counter()
+fitting.get_points({directory!r}, 20)
+stages.append({{'stage': 'offset', 'seconds': time.perf_counter() - start, 'modules': loaded()}})
+print(json.dumps(stages))
+'''
+
+
+def measure(directory):
+    code = STAGES.format(directory=directory, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    directory = os.path.dirname(os.path.abspath(__file__))
+    runs = [measure(directory) for _ in range(repeats)]
+    report = []
+    for i, stage in enumerate(runs[0]):
+        seconds = sorted(run[i]['seconds'] for run in runs)
+        report.append({'stage': stage['stage'], 'median_seconds': seconds[len(seconds) // 2],
+                       'modules': stage['modules']})
+    print(json.dumps(report, indent=2))
+    if 'matplotlib' in runs[0][-1]['modules']:
+        sys.exit('The headless path imported matplotlib')
@@ -0,0 +1,157 @@
+# Binary alternative to contour.txt and curves.json. A file is a 32 byte header
+# followed by the point array, the arc table and the line table, each starting on
+# an 8 byte boundary, so every part maps straight onto a numpy array:
+#   header  magic, version, float size of the points, point, arc and line counts
+#   points  x, y as float32 or float64
+#   arcs    start and end point index, xc, yc, r, start_angle, end_angle
+#   lines   start and end point index
+# A contour is a file without arcs and lines.
+# An offset sweep file holds the curves of one contour for many offsets:
+#   header  magic, version, entry count, sha1 of the contour file
+#   index   offset, position and size of every curves file, sorted by offset
+#   curves  the curves files, each starting on an 8 byte boundary
+# Usage: python binary_curves.py <input> <output>
+# converts between .txt contours, .json curves and .bin files by extension.
+import json
+import sys
+import numpy as np
+
+MAGIC = b'FSCB'
+VERSION = 1
+HEADER = np.dtype([('magic', 'S4'), ('version', '<u2'), ('float_size', '<u2'),
+                   ('points', '<u8'), ('arcs', '<u8'), ('lines', '<u8')])
+ARC = np.dtype([('start', '<u4'), ('end', '<u4'), ('xc', '<f8'), ('yc', '<f8'), ('r', '<f8'),
+                ('start_angle', '<f8'), ('end_angle', '<f8')])
+LINE = np.dtype([('start', '<u4'), ('end', '<u4')])
+SWEEP_MAGIC = b'FSCS'
+SWEEP_HEADER = np.dtype([('magic', 'S4'), ('version', '<u2'), ('reserved', '<u2'), ('count', '<u8'),
+                         ('digest', 'S40')])
+SWEEP_ENTRY = np.dtype([('offset', '<f8'), ('position', '<u8'), ('size', '<u8')])
+
+
+def aligned(offset):
+    return (offset + 7) // 8 * 8
+
+
+def to_bytes(points, arcs=(), lines=(), float_type=np.float64):
+    # points as an array or (x, y) pairs, arcs and lines as ARC and LINE arrays or
+    # as the dicts of curves.json
+    points = np.asarray(points, dtype=np.dtype(float_type).newbyteorder('<')).reshape(-1, 2)
+    if not isinstance(arcs, np.ndarray):
+        arcs = np.array([tuple(arc[name] for name in ARC.names) for arc in arcs], ARC)
+    if not isinstance(lines, np.ndarray):
+        lines = np.array([(line['start'], line['end']) for line in lines], LINE)
+    arcs, lines = arcs.astype(ARC, copy=False), lines.astype(LINE, copy=False)
+    header = np.array((MAGIC, VERSION, points.itemsize, len(points), len(arcs), len(lines)), HEADER)
+    data = bytearray(header.tobytes())
+    data += points.tobytes()
+    data += bytes(aligned(len(data)) - len(data))
+    data += arcs.tobytes()
+    data += lines.tobytes()
+    return bytes(data)
+
+
+def from_buffer(buffer):
+    # Views into buffer, nothing is copied
+    header = np.frombuffer(buffer, HEADER, count=1)[0]
+    if header['magic'] != MAGIC:
+        raise ValueError('Not a binary curves file')
+    if header['version'] != VERSION:
+        raise ValueError('Unsupported binary curves version {}'.format(header['version']))
+    float_type = np.dtype('<f{}'.format(header['float_size']))
+    count = int(header['points'])
+    points_at = HEADER.itemsize
+    arcs_at = aligned(points_at + 2 * count * float_type.itemsize)
+    lines_at = arcs_at + int(header['arcs']) * ARC.itemsize
+    return {'points': np.frombuffer(buffer, float_type, 2 * count, points_at).reshape(-1, 2),
+            'arcs': np.frombuffer(buffer, ARC, int(header['arcs']), arcs_at),
+            'lines': np.frombuffer(buffer, LINE, int(header['lines']), lines_at)}
+
+
+def read(path, mmap=True):
+    buffer = np.memmap(path, np.uint8, 'r') if mmap else np.fromfile(path, np.uint8)
+    return from_buffer(buffer)
+
+
+def write(path, points, arcs=(), lines=(), float_type=np.float64):
+    with open(path, 'wb') as file:
+        file.write(to_bytes(points, arcs, lines, float_type))
+
+
+def curves_bytes(curves, float_type=np.float64):
+    # Binary file of curves.json content; with the fit at hand, pass its arrays to
+    # to_bytes instead
+    return to_bytes([(point['x'], point['y']) for point in curves['points']],
+                    curves['arcs'], curves['lines'], float_type)
+
+
+def write_curves(path, curves, float_type=np.float64):
+    with open(path, 'wb') as file:
+        file.write(curves_bytes(curves, float_type))
+
+
+def sweep_bytes(digest, results):
+    # results as (offset, curves file bytes) pairs
+    results = sorted(results)
+    index = np.zeros(len(results), SWEEP_ENTRY)
+    position = aligned(SWEEP_HEADER.itemsize + index.nbytes)
+    for entry, (offset, data) in zip(index, results):
+        entry['offset'], entry['position'], entry['size'] = offset, position, len(data)
+        position = aligned(position + len(data))
+    header = np.array((SWEEP_MAGIC, VERSION, 0, len(results), digest.encode()), SWEEP_HEADER)
+    data = bytearray(header.tobytes())
+    data += index.tobytes()
+    for _, curves in results:
+        data += bytes(aligned(len(data)) - len(data))
+        data += curves
+    return bytes(data)
+
+
+def read_sweep(path, mmap=True):
+    # (contour digest, offset -> tables), the tables are views like from_buffer's
+    buffer = np.memmap(path, np.uint8, 'r') if mmap else np.fromfile(path, np.uint8)
+    header = np.frombuffer(buffer, SWEEP_HEADER, count=1)[0]
+    if header['magic'] != SWEEP_MAGIC:
+        raise ValueError('Not an offset sweep file')
+    if header['version'] != VERSION:
+        raise ValueError('Unsupported offset sweep version {}'.format(header['version']))
+    index = np.frombuffer(buffer, SWEEP_ENTRY, int(header['count']), SWEEP_HEADER.itemsize)
+    return header['digest'].decode(), {
+        float(offset): from_buffer(buffer[position:position + size]) for offset, position, size in index.tolist()}
+
+
+def tables_to_curves(tables):
+    # curves.json content of the read tables
+    return {'points': [{'x': x, 'y': y} for x, y in tables['points'].tolist()],
+            'arcs': [dict(zip(ARC.names, arc)) for arc in tables['arcs'].tolist()],
+            'lines': [dict(zip(LINE.names, line)) for line in tables['lines'].tolist()]}
+
+
+def read_contour_txt(path):
+    with open(path) as file:
+        rows = [line.strip().split(',') for line in file if line.strip()]
+    return np.array(rows, dtype=float).reshape(-1, 2)
+
+
+def write_contour_txt(path, points):
+    with open(path, 'w') as file:
+        file.writelines('{},{}\n'.format(x, y) for x, y in np.asarray(points).tolist())
+
+
+def convert(source, target, float_type=np.float64):
+    if source.endswith('.bin'):
+        tables = read(source)
+        if target.endswith('.txt'):
+            write_contour_txt(target, tables['points'])
+        else:
+            with open(target, 'w') as file:
+                json.dump(tables_to_curves(tables), file)
+    elif source.endswith('.json'):
+        with open(source) as file:
+            write_curves(target, json.load(file), float_type)
+    else:
+        write(target, read_contour_txt(source), float_type=float_type)
+
+
+if __name__ == '__main__':
+    convert(sys.argv[1], sys.argv[2])
@@ -1,24 +1,106 @@
-import matplotlib.pyplot as plt
+# Contour fitting library. Importing it only loads numpy; scipy and shapely are
+# imported when a fit or an offset needs them and plotting lives in viewer.py.
+import hashlib
+import heapq
+import importlib
+import importlib.util
 import numpy as np
 import json
-import scipy.optimize as optimize
-import shapely
+import os
 import sys
-from matplotlib.widgets import Button
-from functools import partial
-
-
+from bisect import bisect_left, bisect_right, insort
+from functools import cached_property, partial
+
+import binary_curves
+
+
+def opencv_module(name):
+    # cache.py and instrument.py live one directory up, next to the other opencv
+    # scripts. Importers with that directory on their path share their module,
+    # otherwise the file is loaded as foamsizer_<name> so an unrelated module of
+    # the same name on sys.path is neither used nor replaced.
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), name + '.py')
+    spec = importlib.util.find_spec(name)
+    if spec is not None and spec.origin and os.path.abspath(spec.origin) == path:
+        return importlib.import_module(name)
+    qualified = 'foamsizer_' + name
+    if qualified not in sys.modules:
+        spec = importlib.util.spec_from_file_location(qualified, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[qualified] = module
+        spec.loader.exec_module(module)
+    return sys.modules[qualified]
+
+
+_cache, _instrument = opencv_module('cache'), opencv_module('instrument')
+LRUCache, cached_result = _cache.LRUCache, _cache.cached_result
+stage, timed = _instrument.stage, _instrument.timed
+
+# Curves in the on-disk cache are reused while these files stay the same
+SOURCES = (os.path.abspath(__file__), os.path.abspath(binary_curves.__file__))
+# Offset sweeps write the curves of every offset in a range to this file, run()
+# answers offsets from it without fitting
+SWEEP_NAME = '/curves_sweep.bin'
+# (process count, pool) of the sweeps, kept for the next sweep of this process
+_sweep_pool = None
+
+
+class Contour:
+    # Content of a contour.txt or contour.bin, parsed once and buffered once per offset
+    def __init__(self, digest, data):
+        self.digest = digest
+        self.data = data
+
+    @cached_property
+    def array(self):
+        if self.data.startswith(binary_curves.MAGIC):
+            return binary_curves.from_buffer(self.data)['points'].astype(float, copy=False)
+        rows = [line.strip().split(',') for line in self.data.decode().splitlines() if line.strip()]
+        return np.array(rows, dtype=float).reshape(-1, 2)
+
+    @cached_property
+    def polygon(self):
+        import shapely
+        polygon = shapely.geometry.Polygon(self.array)
+        shapely.prepare(polygon)
+        return polygon
+
+    def points(self, offset=0):
+        if offset == 0:
+            return [tuple(point) for point in self.array.tolist()]
+        import shapely
+        with stage('fitting.buffer'):
+            return shapely.get_coordinates(self.polygon.buffer(offset).simplify(2)).tolist()
+
+
+# A long-lived process re-running the fit for offsets the user already tried gets the
+# points and the curves from here, keyed by the contour.txt content hash
+CONTOURS = LRUCache(16)
+OFFSETS = LRUCache(64)
+CURVES = LRUCache(64)
+
+
+def read_contour(path):
+    # contour.txt, or contour.bin for contours that only come in the binary format
+    name = path + '/contour.txt'
+    if not os.path.exists(name) and os.path.exists(path + '/contour.bin'):
+        name = path + '/contour.bin'
+    with open(name, 'rb') as file:
+        data = file.read()
+    digest = hashlib.sha1(data).hexdigest()
+    return CONTOURS.get(digest, lambda: Contour(digest, data))
+
+
+def offset_points(contour, offset=0):
+    # Callers get their own list and points, the cached ones stay untouched. The
+    # points of offset 0 are tuples and shared, buffered points are [x, y] lists.
+    points = OFFSETS.get((contour.digest, offset), lambda: contour.points(offset))
+    return [list(point) if isinstance(point, list) else point for point in points]
+
+
+@timed()
 def get_points(path, offset=0):
-    points = []
-    with open(path + '/contour.txt', 'r') as file:
-        for line in file:
-            x, y = line.strip().split(',')
-            points.append((float(x), float(y)))
-    # Offset points
-    if offset != 0:
-        polygon_shape = shapely.geometry.Polygon(points)
-        return shapely.get_coordinates(polygon_shape.buffer(offset).simplify(2)).tolist()
-    return points
+    return offset_points(read_contour(path), offset)
 
 
 def point_distance(p1, p2):
@@ -26,10 +108,11 @@ def point_distance(p1, p2):
 
 
 def contour_length(points):
-    length = 0
-    for i in range(len(points) - 1):
-        length += point_distance(points[i], points[i + 1])
-    return length
+    # Summed in order like a loop over point_distance, so thresholds do not move
+    if len(points) < 2:
+        return 0
+    steps = np.diff(np.asarray(points, dtype=float), axis=0)
+    return float(np.cumsum(np.sqrt(steps[:, 0]**2 + steps[:, 1]**2))[-1])
 
 
 def get_points_for_min_length(points, min_length):
@@ -48,7 +131,10 @@ def get_points_for_min_length(points, min_length):
     return new_points
 
 
-def fit_circle(points):
+@timed()
+def fit_circle(points, initial_guess=None):
+    import scipy.optimize as optimize
+
     def calc_R(xc, yc):
         return np.sqrt((points[:, 0] - xc)**2 + (points[:, 1] - yc)**2)
 
@@ -57,11 +143,12 @@ def fit_circle(points):
         return calc_R(xc, yc) - r
 
     # Initial guess: center (xc, yc) at mean of points, radius as mean distance to mean point
-    x_m = np.mean(points[:, 0])
-    y_m = np.mean(points[:, 1])
-    r_guess = np.mean(
-        np.sqrt((points[:, 0] - x_m)**2 + (points[:, 1] - y_m)**2))
-    initial_guess = [x_m, y_m, r_guess]
+    if initial_guess is None:
+        x_m = np.mean(points[:, 0])
+        y_m = np.mean(points[:, 1])
+        r_guess = np.mean(
+            np.sqrt((points[:, 0] - x_m)**2 + (points[:, 1] - y_m)**2))
+        initial_guess = [x_m, y_m, r_guess]
 
     # Optimize the parameters
     result = optimize.least_squares(cost, initial_guess)
@@ -144,106 +231,150 @@ def angle_direction(start_angle, end_angle, start_point, end_point, center_point
     return "ccw"
 
 
-def main_plot():
-    ax.clear()
-    height, width = main_image.shape[:2]
-    ax.imshow(main_image, extent=[0, width/1.1811, height/1.1811, 0])
-    # First point in blue
-    ax.plot(*points[0], 'bo')
-    ax.plot(*zip(*points[1:]), 'ro')
-
-
-def draw_arc(center, radius, start_angle, end_angle):
-    theta = points_between_angles(start_angle, end_angle, 10)
-    x_fit = center[0] + radius * np.cos(np.deg2rad(theta))
-    y_fit = center[1] + radius * np.sin(np.deg2rad(theta))
-    ax.plot(x_fit, y_fit, 'g-')
+def select_non_overlapping(candidates, size, interval):
+    # Greedy keep-largest selection: candidates are taken by descending size (ties
+    # go to the later one) and dropped if a kept candidate K overlaps them, i.e.
+    # start <= K.start < end or K.start <= start < K.end. Kept starts and the kept
+    # intervals, which are disjoint, stay sorted so every check is a bisect.
+    kept = []
+    kept_starts = []
+    # Non-empty kept intervals as sorted starts and their ends
+    interval_starts = []
+    interval_ends = []
+    for candidate in reversed(sorted(candidates, key=size)):
+        start, end = interval(candidate)
+        # A kept start inside [start, end)
+        if bisect_left(kept_starts, start) < bisect_left(kept_starts, end):
+            continue
+        # A kept interval containing start
+        i = bisect_right(interval_starts, start) - 1
+        if i >= 0 and start < interval_ends[i]:
+            continue
+        kept.append(candidate)
+        insort(kept_starts, start)
+        if start < end:
+            i = bisect_right(interval_starts, start)
+            interval_starts.insert(i, start)
+            interval_ends.insert(i, end)
+    return kept
 
 
 def filter_arcs(arcs):
-    # if arcs overlap, only draw the larger one
-    clean_arcs = []
-    # Sort the arcs by distance
-    arcs = sorted(arcs, key=lambda x: x['distance'])
-    while len(arcs) > 0:
-        arc = arcs.pop()
-        for remaining in arcs[:]:
-            if (remaining['start'] <= arc['start'] and remaining['end'] > arc['start']) or \
-                    (remaining['start'] < arc['end'] and remaining['start'] >= arc['start']):
-                # Remove the smaller arc
-                arcs.remove(remaining)
-        clean_arcs.append(arc)
-    return clean_arcs
-
-
-def draw_all_arcs(arcs):
-    for arc in arcs:
-        draw_arc((arc['xc'], arc['yc']), arc['r'],
-                 arc['start_angle'], arc['end_angle'])
+    # if arcs overlap, only draw the larger one (the one with the larger distance)
+    return select_non_overlapping(arcs, lambda x: x['distance'], lambda x: (x['start'], x['end']))
 
 
 def arc_length(arc):
     return arc['r'] * np.deg2rad(np.abs(arc['end_angle'] - arc['start_angle']))
 
 
-def find_arcs(arc_length_threshold, arc_deviation_threshold):
-    current_index = 0
-    segment_size = 0
+def circle_moments(points):
+    # Prefix sums of the moments needed for an algebraic circle fit, so the sums
+    # over any index window [i, j) are moments[j] - moments[i]
+    x = points[:, 0]
+    y = points[:, 1]
+    z = x**2 + y**2
+    terms = np.stack([np.ones_like(x), x, y, x * x, y * y,
+                     x * y, z, x * z, y * z, z * z], axis=1)
+    return np.concatenate((np.zeros((1, 10)), np.cumsum(terms, axis=0)))
+
+
+def algebraic_circle(sums):
+    # Kasa fit of x^2 + y^2 + D*x + E*y + F = 0 from the running moment sums.
+    # Returns center, radius and an estimate of the geometric squared residual sum
+    n, sx, sy, sxx, syy, sxy, sz, sxz, syz, szz = sums
+    bx, by, bz = -sxz, -syz, -sz
+    det = sxx * (syy * n - sy * sy) - sxy * (sxy * n - sy * sx) + \
+        sx * (sxy * sy - syy * sx)
+    # det is n times the determinant of the point covariance, which is 0 for points
+    # on a line; rounding leaves a small remainder that would give a bogus circle
+    spread = sxx + syy - (sx * sx + sy * sy) / n
+    if det <= 1e-9 * n * spread**2:
+        return None
+    d = (bx * (syy * n - sy * sy) - sxy * (by * n - sy * bz) +
+         sx * (by * sy - syy * bz)) / det
+    e = (sxx * (by * n - sy * bz) - bx * (sxy * n - sy * sx) +
+         sx * (sxy * bz - by * sx)) / det
+    f = (sxx * (syy * bz - by * sy) - sxy * (sxy * bz - by * sx) +
+         bx * (sxy * sy - syy * sx)) / det
+    xc = -d / 2
+    yc = -e / 2
+    r_sq = xc**2 + yc**2 - f
+    if r_sq <= 0:
+        return None
+    # Algebraic residual sum((d_i^2 - r^2)^2), which is about 4r^2 times the geometric one
+    residual = max(szz + d * sxz + e * syz + f * sz, 0)
+    return xc, yc, np.sqrt(r_sq), residual / (4 * r_sq)
+
+
+@timed()
+def find_arcs(points, arc_length_threshold, arc_deviation_threshold):
+    # Grow arc segments point by point. The circle for every candidate segment
+    # comes from an algebraic fit on prefix moment sums, so adding a point is O(1);
+    # the least squares fit only runs on the arcs that survive filtering.
+    points_np = np.asarray(points, dtype=float)
+    n = len(points_np)
+    if n < 4:
+        return []
+    # Center the coordinates to keep the moment sums well conditioned
+    origin = points_np.mean(axis=0)
+    moments = circle_moments(points_np - origin)
+    edges = np.linalg.norm(np.diff(points_np, axis=0), axis=1)
+    cumulative = np.concatenate(([0], np.cumsum(edges)))
     arc_segments = []
-    for index in range(0, len(points)):
-        if index < current_index:
-            continue
-        for i in points[current_index:]:
-            # An arc segment should have atleast 4 points
-            if segment_size < 4:
-                segment_points = get_points_for_min_length(
-                    points[current_index:], arc_length_threshold)
-                segment_size = len(segment_points)
-                while segment_size < 4:
-                    if current_index + segment_size < len(points):
-                        segment_points.append(
-                            points[current_index + segment_size])
-                        segment_size += 1
-                    else:
-                        overflow = current_index + segment_size - len(points)
-                        # segment_points.append(points[overflow])
-                        # segment_size += 1
-                        break  # not implemented yet
-            else:
-                if current_index + segment_size < len(points):
-                    segment_points.append(points[current_index + segment_size])
-                    segment_size += 1
-                else:
-                    overflow = current_index + segment_size - len(points)
-                    # segment_points.append(points[overflow])
-                    # segment_size += 1
-                    break  # not implemented yet
-            # There are now atleast 4 points with a minimum length of arc_length_threshold
-            segment_points_np = np.array(segment_points)
-            # Get largest distance between points
-            point_distances = np.linalg.norm(
-                segment_points_np - np.roll(segment_points_np, 1, axis=0), axis=1)
-            max_distance = np.sum(point_distances) - np.max(point_distances)
-            # Fit a circle to the segment points
-            xc, yc, r, start_angle, end_angle, r_squared = fit_circle(
-                segment_points_np)
-            # If the arc is valid, add it to the list of arc segments and try to fit more points
-            if abs(r_squared) < arc_deviation_threshold and arc_length({'r': r, 'start_angle': start_angle, 'end_angle': end_angle}) < max_distance * 1.05 and r < 5000:
-                # Delete shorter arcs that overlap with the current arc
-                # if len(arc_segments) > 0:
-                #     if arc_segments[-1]['start'] == current_index:
-                #         arc_segments.pop()
-                arc_segments.append(
-                    {'start': current_index, 'end': current_index + segment_size-1, 'xc': xc, 'yc': yc, 'r': r,
-                     'start_angle': start_angle, 'end_angle': end_angle, 'distance': point_distance(points[current_index], points[current_index + segment_size - 1]),
-                     'start_point': points[current_index], 'end_point': points[current_index + segment_size - 1]})
-                continue
-            # If the arc is invalid, go to the next point
-            else:
+    current_index = 0
+    # An arc segment should have atleast 4 points
+    while current_index + 4 <= n:
+        # Minimum number of points to reach arc_length_threshold, like get_points_for_min_length
+        last = int(np.searchsorted(
+            cumulative, cumulative[current_index] + arc_length_threshold))
+        segment_size = last - current_index + 1 if last < n else n - 1 - current_index
+        segment_size = max(segment_size, 4)
+        end = current_index + segment_size - 1
+        polyline_length = cumulative[end] - cumulative[current_index]
+        longest_edge = np.max(edges[current_index:end])
+        while True:
+            # Polyline length without its longest edge, the closing chord included
+            chord = point_distance(points_np[current_index], points_np[end])
+            max_distance = polyline_length + chord - max(longest_edge, chord)
+            circle = algebraic_circle(
+                (moments[end + 1] - moments[current_index]).tolist())
+            valid = False
+            if circle is not None:
+                xc, yc, r, deviation = circle
+                start_angle = np.rad2deg(np.arctan2(
+                    points_np[current_index][1] - origin[1] - yc, points_np[current_index][0] - origin[0] - xc))
+                end_angle = np.rad2deg(np.arctan2(
+                    points_np[end][1] - origin[1] - yc, points_np[end][0] - origin[0] - xc))
+                valid = deviation < arc_deviation_threshold and r < 5000 and \
+                    arc_length({'r': r, 'start_angle': start_angle, 'end_angle': end_angle}) < max_distance * 1.05
+            if not valid:
+                # Go to the next point
                 current_index += 1
-                segment_size = 0
                 break
-    return filter_arcs(arc_segments)
+            # Add the arc segment and try to fit more points
+            arc_segments.append(
+                {'start': current_index, 'end': end, 'xc': xc + origin[0], 'yc': yc + origin[1], 'r': r,
+                 'start_angle': start_angle, 'end_angle': end_angle, 'distance': chord,
+                 'start_point': points[current_index], 'end_point': points[end]})
+            if end + 1 >= n:
+                # Wrapping around the contour end is not implemented yet
+                return refine_arcs(points_np, filter_arcs(arc_segments))
+            polyline_length += edges[end]
+            longest_edge = max(longest_edge, edges[end])
+            end += 1
+    return refine_arcs(points_np, filter_arcs(arc_segments))
+
+
+@timed()
+def refine_arcs(points, arcs):
+    # Geometric least squares fit of the accepted arcs, seeded with the algebraic fit
+    for arc in arcs:
+        xc, yc, r, start_angle, end_angle, _ = fit_circle(
+            points[arc['start']:arc['end'] + 1], (arc['xc'], arc['yc'], arc['r']))
+        arc.update({'xc': xc, 'yc': yc, 'r': r,
+                   'start_angle': start_angle, 'end_angle': end_angle})
+    return arcs
 
 
 def get_non_arc_points(arcs, points):
@@ -281,60 +412,162 @@ def calc_line_deviation(line, points):
 
 def filter_lines(lines):
     # If lines overlap, only draw the larger one
-    clean_lines = []
-    # Sort the lines by length
-    lines = sorted(lines, key=lambda x: x['length'])
-    while len(lines) > 0:
-        line = lines.pop()
-        for remaining in lines[:]:
-            if (remaining['start'][2] <= line['start'][2] and remaining['end'][2] > line['start'][2]) or \
-               (remaining['start'][2] >= line['start'][2] and remaining['start'][2] < line['end'][2]):
-                # Remove the smaller line
-                lines.remove(remaining)
-        clean_lines.append(line)
-    return clean_lines
+    return select_non_overlapping(lines, lambda x: x['length'], lambda x: (x['start'][2], x['end'][2]))
+
+
+def line_moments(points):
+    # Prefix sums of [1, x, y, x*x, y*y, x*y], so the sums over any index window
+    # [i, j) are moments[j] - moments[i]
+    x = points[:, 0]
+    y = points[:, 1]
+    terms = np.stack([np.ones_like(x), x, y, x * x, y * y, x * y], axis=1)
+    return np.concatenate((np.zeros((1, 6)), np.cumsum(terms, axis=0)))
+
+
+def segment_deviation(points, start, end):
+    # calc_line_deviation of points[start:end + 1] in one vectorized pass
+    x1, y1 = points[start]
+    x2, y2 = points[end]
+    x0 = points[start:end + 1, 0]
+    y0 = points[start:end + 1, 1]
+    return np.mean(np.abs((y2-y1)*x0 - (x2-x1)*y0 + x2*y1 - y2*x1) / np.sqrt((y2-y1)**2 + (x2-x1)**2))
+
+
+def segment_deviations(points, start, ends):
+    # segment_deviation for several ends at once, up to rounding in the last bits
+    x1, y1 = points[start]
+    x2 = points[ends, 0, None]
+    y2 = points[ends, 1, None]
+    x0 = points[start:ends[-1] + 1, 0]
+    y0 = points[start:ends[-1] + 1, 1]
+    distances = np.abs((y2-y1)*x0 - (x2-x1)*y0 + x2*y1 - y2*x1) / np.sqrt((y2-y1)**2 + (x2-x1)**2)
+    distances[np.arange(len(x0)) > (ends - start)[:, None]] = 0
+    return distances.sum(axis=1) / (ends - start + 1)
+
+
+def first_deviating_end(points, start, ends, rejected, line_deviation_threshold, size=1 << 18):
+    # First of the ends, in order, whose segment deviates by the threshold or more.
+    # rejected marks ends already known to deviate. Batches of ends are measured
+    # together and only results within rounding of the threshold are measured again
+    # the way calc_line_deviation does it.
+    accept_below = line_deviation_threshold * (1 - 1e-9)
+    reject_above = line_deviation_threshold * (1 + 1e-9)
+    rows = max(size // (ends[-1] - start + 1), 1) if len(ends) else 1
+    for first in range(0, len(ends), rows):
+        batch = ends[first:first + rows]
+        known = np.flatnonzero(rejected[first:first + rows])
+        count = known[0] if len(known) else len(batch)
+        if count:
+            deviations = segment_deviations(points, start, batch[:count])
+            for k in np.flatnonzero(~(deviations < accept_below)):
+                if deviations[k] > reject_above or \
+                        not segment_deviation(points, start, batch[k]) < line_deviation_threshold:
+                    return batch[k]
+        if count < len(batch):
+            return batch[count]
+    return None
+
+
+def segment_ends(points, line_deviation_threshold, chunk=64):
+    # For every start the last end the segment grows to before its mean distance
+    # reaches the threshold. The mean distance lies between the mean signed distance
+    # and the root mean square distance, which both come from the prefix moments, so
+    # ends are tested a chunk at a time and only the ones the bounds can't decide are
+    # measured over their points.
+    n = len(points)
+    centered = points - points.mean(axis=0)
+    moments = line_moments(centered)
+    accept_below = line_deviation_threshold * (1 - 1e-9)
+    reject_above = line_deviation_threshold * (1 + 1e-9)
+    last = np.arange(1, n + 1)
+    for start in range(n - 2):
+        x1, y1 = centered[start]
+        first = start + 2
+        # Neighbouring starts tend to grow about as far
+        size = max(last[start - 1] - start, 0) + chunk if start else chunk
+        while first < n:
+            ends = np.arange(first, min(first + size, n))
+            dx = centered[ends, 0] - x1
+            dy = centered[ends, 1] - y1
+            # Distances are (dy*x - dx*y + c) / norm for the line through start and end
+            c = dx * y1 - dy * x1
+            count, sx, sy, sxx, syy, sxy = (moments[ends + 1] - moments[start]).T
+            signed = dy * sx - dx * sy + c * count
+            squared = dy * dy * sxx + dx * dx * syy + c * c * count - 2 * dx * dy * sxy + \
+                2 * c * (dy * sx - dx * sy)
+            norm = np.sqrt(dx * dx + dy * dy)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                lower = np.abs(signed) / (count * norm)
+                upper = np.sqrt(np.maximum(squared, 0) / count) / norm
+            # Coinciding start and end points give nan and stop the growth
+            rejected = ~(lower <= reject_above)
+            undecided = np.flatnonzero(~(upper < accept_below))
+            stop = first_deviating_end(points, start, ends[undecided], rejected[undecided],
+                                       line_deviation_threshold)
+            if stop is not None:
+                last[start] = stop - 1
+                break
+            first = ends[-1] + 1
+            size *= 2
+        else:
+            last[start] = n - 1
+    return last
 
 
-def find_lines(points, arcs, line_deviation_threshold):
-    available_points = get_non_arc_points(arcs, points)
-    # Find straight lines between arcs
-    lines = []
-    for point_group in available_points:
-        for i in range(len(point_group) - 1):
-            segment_size = 1
-            segment = point_group[i: i + segment_size+1]
-            start_point = segment[0]
-            end_point = segment[-1]
-            deviation = calc_line_deviation(
-                (start_point[0], start_point[1], end_point[0], end_point[1]), segment)
-            lines.append({'start': start_point, 'end': end_point, 'deviation': deviation,
-                          'length': point_distance(start_point, end_point)})
-            while deviation < line_deviation_threshold:
-                lines.append({'start': start_point, 'end': end_point, 'deviation': deviation,
-                              'length': point_distance(start_point, end_point)})
-                if i + segment_size < len(point_group):
-                    segment_size += 1
-                    segment = point_group[i: i + segment_size+1]
-                    end_point = segment[-1]
-                    deviation = calc_line_deviation(
-                        (start_point[0], start_point[1], end_point[0], end_point[1]), segment)
-                else:
-                    break
-    return filter_lines(lines)
-
-
-def draw_line(line):
-    x_fit = [line['start'][0], line['end'][0]]
-    y_fit = [line['start'][1], line['end'][1]]
-    ax.plot(x_fit, y_fit, 'b-')
-
-
-def draw_all_lines(lines):
-    for line in lines:
-        draw_line(line)
+def longest_segment(points, start, last):
+    # Longest chord from start to an end in (start, last], ties go to the later end
+    # like they do in filter_lines
+    ends = np.arange(start + 1, last + 1)
+    lengths = np.sqrt((points[start, 0] - points[ends, 0])**2 + (points[start, 1] - points[ends, 1])**2)
+    k = len(lengths) - 1 - int(np.argmax(lengths[::-1]))
+    return lengths[k], int(ends[k])
 
 
-def lines_to_file(path, lines, arcs, points):
+@timed()
+def find_lines(points, arcs, line_deviation_threshold):
+    # Find straight lines between arcs. Every start grows to the last end within the
+    # deviation threshold (segment_ends), and instead of listing every grown segment
+    # for filter_lines each start offers its longest segment to a heap. Popping the
+    # heap gives the segments in the order filter_lines takes them; a start whose
+    # segment no longer ends before the next kept start offers its longest shorter one.
+    heap = []
+    groups = []
+    for point_group in get_non_arc_points(arcs, points):
+        group = np.array([point[:2] for point in point_group], dtype=float)
+        last = segment_ends(group, line_deviation_threshold)
+        offset = point_group[0][2]
+        for start in range(len(group) - 1):
+            length, end = longest_segment(group, start, last[start])
+            heapq.heappush(heap, (-length, -(offset + start), -(offset + end), len(groups), last[start]))
+        groups.append((point_group, group, offset))
+    lines = []
+    kept_starts = []
+    kept_ends = []
+    while heap:
+        _, start, end, g, last = heapq.heappop(heap)
+        start, end = -start, -end
+        point_group, group, offset = groups[g]
+        # Dropped if a kept line contains the start
+        i = bisect_right(kept_starts, start)
+        if i > 0 and start < kept_ends[i - 1]:
+            continue
+        # Or if a kept line starts before the end
+        if i < len(kept_starts) and kept_starts[i] < end:
+            length, end = longest_segment(group, start - offset, min(last, kept_starts[i] - offset))
+            heapq.heappush(heap, (-length, -start, -(offset + end), g, last))
+            continue
+        kept_starts.insert(i, start)
+        kept_ends.insert(i, end)
+        start_point = point_group[start - offset]
+        end_point = point_group[end - offset]
+        deviation = calc_line_deviation(
+            (start_point[0], start_point[1], end_point[0], end_point[1]), point_group[start - offset:end - offset + 1])
+        lines.append({'start': start_point, 'end': end_point, 'deviation': deviation,
+                      'length': point_distance(start_point, end_point)})
+    return lines
+
+
+def to_curves(lines, arcs, points):
     curves = {'points': [], 'arcs': [], 'lines': []}
     for point in points:
         curves['points'].append(
@@ -349,49 +582,142 @@ def lines_to_file(path, lines, arcs, points):
         curves['lines'].append(
             {'start': int(line['start'][2]),
              'end': int(line['end'][2])})
+    return curves
+
+
+def curves_tables(lines, arcs, points):
+    # The fit as the point, arc and line arrays of the binary format, without the
+    # per-point dicts of curves.json
+    return (np.asarray(points, dtype=float).reshape(-1, 2),
+            np.array([tuple(arc[name] for name in binary_curves.ARC.names) for arc in arcs], binary_curves.ARC),
+            np.array([(line['start'][2], line['end'][2]) for line in lines], binary_curves.LINE))
+
+
+def write_curves(path, curves, binary=False):
+    # curves.json, and curves.bin next to it in the binary format if asked for
     with open(path + '/curves.json', 'w') as file:
         file.write(json.dumps(curves))
+    if binary:
+        binary_curves.write_curves(path + '/curves.bin', curves)
 
 
-def callback(event, draw=True, points=[], arc_length_threshold=0, arc_deviation_threshold=0, line_deviation_threshold=0):
-    arcs = find_arcs(arc_length_threshold, arc_deviation_threshold)
-    lines = find_lines(points, arcs, line_deviation_threshold)
+def lines_to_file(path, lines, arcs, points):
+    write_curves(path, to_curves(lines, arcs, points))
+
+
+def default_params(points):
+    # Thresholds used by the app, the minimum arc length scales with the contour
+    circumference = contour_length(points)
+    return {'arc_length_threshold': 0.1 * circumference,
+            'arc_deviation_threshold': 100,
+            'line_deviation_threshold': 5}
+
+
+@timed()
+def fit_contour(points, params):
+    # Fit arcs and the straight lines between them to a contour
+    arcs = find_arcs(points, params['arc_length_threshold'],
+                     params['arc_deviation_threshold'])
+    lines = find_lines(points, arcs, params['line_deviation_threshold'])
+    return {'arcs': arcs, 'lines': lines}
+
+
+def offset_curves(contour, offset, params=None):
+    # curves.json content of the contour at offset, fitted with params or the app's
+    # thresholds, from memory, the on-disk cache or a new fit. The app's thresholds
+    # only depend on the points, None stands for them in the keys.
+    def fit():
+        points = offset_points(contour, offset)
+        result = fit_contour(points, default_params(points) if params is None else params)
+        return to_curves(result['lines'], result['arcs'], points)
+    thresholds = None if params is None else tuple(sorted(params.items()))
+    return CURVES.get((contour.digest, offset, thresholds),
+                      lambda: cached_result('curves', contour.digest, [offset, params], SOURCES, fit))
+
+
+def offset_curves_bytes(contour, offset, params=None):
+    # curves.bin content of the contour at offset, fitted like offset_curves but
+    # written straight from the arrays
+    def fit():
+        points = offset_points(contour, offset)
+        result = fit_contour(points, default_params(points) if params is None else params)
+        return binary_curves.to_bytes(*curves_tables(result['lines'], result['arcs'], points))
+    return cached_result('curves_bin', contour.digest, [offset, params], SOURCES, fit)
+
+
+def swept_curves(path, contour, offset):
+    # Curves from the sweep file of this contour, None if it has not swept offset
+    if not os.path.exists(path + SWEEP_NAME):
+        return None
+    digest, results = binary_curves.read_sweep(path + SWEEP_NAME)
+    if digest != contour.digest or offset not in results:
+        return None
+    return binary_curves.tables_to_curves(results[offset])
+
+
+@timed()
+def run(path, offset, draw=False, binary=False):
+    contour = read_contour(path)
     if draw:
-        main_plot()
-        draw_all_arcs(arcs)
-        draw_all_lines(lines)
-    plt.draw()
-    lines_to_file(path, lines, arcs, points)
+        import viewer
+        points = offset_points(contour, offset)
+        viewer.show(path, points, default_params(points))
+    else:
+        curves = swept_curves(path, contour, offset)
+        write_curves(path, curves if curves is not None else offset_curves(contour, offset), binary)
+
+
+def sweep_offsets(start, stop, step):
+    # start to stop inclusive, whole numbers stay ints like the offsets run() gets
+    count = int(np.floor((stop - start) / step + 1e-9)) + 1
+    offsets = [round(start + i * step, 9) for i in range(max(count, 0))]
+    return [int(offset) if float(offset).is_integer() else offset for offset in offsets]
+
+
+def sweep_pool(processes):
+    # Starting the processes costs more than sweeping a few offsets, more so where
+    # they are spawned and import numpy again (Windows, macOS), so a long-lived
+    # process like the worker keeps its pool. A pool of another size replaces it.
+    global _sweep_pool
+    if _sweep_pool is not None and _sweep_pool[0] != processes:
+        _sweep_pool[1].terminate()
+        _sweep_pool = None
+    if _sweep_pool is None:
+        from multiprocessing import Pool
+        _sweep_pool = (processes, Pool(processes))
+    return _sweep_pool[1]
+
+
+def _sweep_offset(digest, data, offset):
+    # Every pool process parses the contour and prepares its polygon once per
+    # content, through the contour cache
+    return offset, offset_curves_bytes(CONTOURS.get(digest, lambda: Contour(digest, data)), offset)
+
+
+@timed()
+def sweep(path, start, stop, step, processes=None):
+    # Fits every offset of the range, in parallel across processes, and writes
+    # them to the sweep file. Returns the offsets.
+    contour = read_contour(path)
+    offsets = sweep_offsets(start, stop, step)
+    processes = min(processes or os.cpu_count() or 1, len(offsets))
+    if processes > 1:
+        results = sweep_pool(processes).map(partial(_sweep_offset, contour.digest, contour.data), offsets)
+    else:
+        results = [(offset, offset_curves_bytes(contour, offset)) for offset in offsets]
+    with open(path + SWEEP_NAME, 'wb') as file:
+        file.write(binary_curves.sweep_bytes(contour.digest, results))
+    return offsets
 
 
 if __name__ == '__main__':
-    # Get command line args
+    # fitting.py <path> <offset> [draw | binary]
+    # fitting.py <path> sweep <start> <stop> <step> [processes]
     path = sys.argv[1]
-    offset = int(sys.argv[2])
-    if len(sys.argv) > 3:
-        draw = True
-    else:
-        draw = False
-
-    # Algorithm
-    points = get_points(path, offset)
-    circumference = contour_length(points)
-    arc_length_threshold = 0.1 * circumference
-    arc_deviation_threshold = 100
-    line_deviation_threshold = 5
-    callback_args = partial(callback, draw=True, points=points, arc_length_threshold=arc_length_threshold,
-                            arc_deviation_threshold=arc_deviation_threshold, line_deviation_threshold=line_deviation_threshold)
-    # Plot Setup
-    if draw:
-        main_image = plt.imread(path + '/main.png')
-        fig, ax = plt.subplots()
-        plt.subplots_adjust(bottom=0.2)
-        main_plot()
-        plt.draw()
-        axnext = fig.add_axes([0.7, 0.05, 0.1, 0.075])
-        bnext = Button(axnext, 'Next')
-        bnext.on_clicked(callback_args)
-        plt.show()
+    if sys.argv[2] == 'sweep':
+        sweep(path, *map(float, sys.argv[3:6]), *map(int, sys.argv[6:7]))
     else:
-        callback(event=None, draw=False, points=points, arc_length_threshold=arc_length_threshold,
-                 arc_deviation_threshold=arc_deviation_threshold, line_deviation_threshold=line_deviation_threshold)
+        offset = int(sys.argv[2])
+        binary = sys.argv[3:] == ['binary']
+        draw = len(sys.argv) > 3 and not binary
+        run(path, offset, draw, binary)
@@ -0,0 +1,194 @@
+# Lays out buffered tool outlines in a rectangular foam tray. Tools are placed
+# largest first at the lowest, then leftmost free position (bottom-left fill) over
+# a set of rotations, then the tools that end highest are taken out and placed
+# again while that lowers the layout. y = 0 is the bottom of the tray.
+# A placement rotates the outline about the origin by rotation degrees and then
+# moves it by (x, y).
+import numpy as np
+import shapely
+
+ROTATIONS = (0, 90, 180, 270)
+# Positions are settled down and left to within this distance
+TOLERANCE = 0.5
+# Candidate positions checked per collision query
+BATCH = 32
+
+
+class CollisionIndex:
+    # Placed outlines, prepared and behind an STRtree. A tree cannot take new
+    # geometries, it is rebuilt on every change, which costs far less than the
+    # queries between changes
+    def __init__(self):
+        self.geometries = []
+        self.tree = None
+        self.queries = 0
+
+    def add(self, geometry):
+        shapely.prepare(geometry)
+        self.geometries.append(geometry)
+        self.reindex()
+
+    def remove(self, position):
+        del self.geometries[position]
+        self.reindex()
+
+    def reindex(self):
+        self.array = np.array(self.geometries, dtype=object)
+        self.tree = shapely.STRtree(self.array) if self.geometries else None
+
+    def collisions(self, geometries):
+        # Whether each geometry overlaps a placed outline, touching is allowed
+        self.queries += len(geometries)
+        result = np.zeros(len(geometries), bool)
+        if self.tree is None:
+            return result
+        query, placed = self.tree.query(geometries)
+        if len(query):
+            others, candidates = self.array[placed], geometries[query]
+            overlap = shapely.intersects(others, candidates) & ~shapely.touches(others, candidates)
+            result[query[overlap]] = True
+        return result
+
+
+class Shape:
+    # One rotation of an outline, moved so its bounds start at the origin
+    def __init__(self, polygon, rotation):
+        rotated = shapely.affinity.rotate(polygon, rotation, origin=(0, 0))
+        minx, miny, maxx, maxy = rotated.bounds
+        self.rotation = rotation
+        self.origin = (minx, miny)
+        self.width, self.height = maxx - minx, maxy - miny
+        self.ring = shapely.get_coordinates(rotated.exterior) - self.origin
+        self.hull = shapely.get_coordinates(rotated.convex_hull.exterior) - self.origin
+
+    def at(self, positions):
+        # Polygons of the shape moved to each (x, y)
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        coords = (self.ring[None] + positions[:, None]).reshape(-1, 2)
+        rings = shapely.linearrings(coords, indices=np.repeat(np.arange(len(positions)), len(self.ring)))
+        return shapely.polygons(rings)
+
+    def swept(self, position, moves):
+        # Convex hull of the shape at position and moved by each (dx, dy), which
+        # covers everything the move passes over
+        start = self.hull + position
+        ends = start[None] + np.asarray(moves, dtype=float)[:, None]
+        coords = np.concatenate([np.broadcast_to(start, ends.shape), ends], axis=1).reshape(-1, 2)
+        points = shapely.multipoints(coords, indices=np.repeat(np.arange(len(moves)), 2 * len(start)))
+        return shapely.convex_hull(points)
+
+
+class Part:
+    def __init__(self, index, outline, rotations):
+        polygon = shapely.Polygon(outline)
+        self.index = index
+        self.area = polygon.area
+        self.shapes = [Shape(polygon, rotation) for rotation in rotations]
+
+
+def settle(index, shape, x, y):
+    # Moves a placed shape down and left as far as it goes without passing a tool,
+    # in halving steps
+    moved = True
+    while moved:
+        moved = False
+        for axis in (1, 0):
+            distance = (x, y)[axis]
+            steps = []
+            while distance > TOLERANCE:
+                steps.append(distance)
+                distance /= 2
+            if not steps:
+                continue
+            moves = np.zeros((len(steps), 2))
+            moves[:, axis] = -np.array(steps)
+            free = np.flatnonzero(~index.collisions(shape.swept((x, y), moves)))
+            if len(free):
+                x, y = x + moves[free[0], 0], y + moves[free[0], 1]
+                moved = True
+    return x, y
+
+
+def candidate_positions(placed):
+    # Bottom-left corners next to and on top of the placed bounds, lowest first
+    positions = {(0.0, 0.0)}
+    for minx, miny, maxx, maxy in placed:
+        positions.update([(maxx, miny), (minx, maxy), (maxx, 0.0), (0.0, maxy)])
+    positions = np.array(sorted(positions, key=lambda position: (position[1], position[0])))
+    return positions
+
+
+def place(part, index, placed, width, height):
+    # Lowest, then leftmost position over all rotations as (placement, geometry),
+    # or None if the part does not fit anymore
+    best = None
+    positions = candidate_positions(placed)
+    for shape in part.shapes:
+        fits = positions[(positions[:, 0] + shape.width <= width) & (positions[:, 1] + shape.height <= height)]
+        if best is not None:
+            y, x = best[:2]
+            fits = fits[(fits[:, 1] < y) | ((fits[:, 1] == y) & (fits[:, 0] < x))]
+        for start in range(0, len(fits), BATCH):
+            batch = fits[start:start + BATCH]
+            free = np.flatnonzero(~index.collisions(shape.at(batch)))
+            if len(free):
+                x, y = settle(index, shape, *batch[free[0]])
+                if best is None or (y, x) < best[:2]:
+                    best = (y, x, shape)
+                break
+    if best is None:
+        return None
+    y, x, shape = best
+    placement = {'index': part.index, 'rotation': shape.rotation,
+                 'x': float(x - shape.origin[0]), 'y': float(y - shape.origin[1])}
+    return placement, shape.at([(x, y)])[0]
+
+
+def used_height(geometries):
+    return max((geometry.bounds[3] for geometry in geometries), default=0)
+
+
+def nest(outlines, width, height, rotations=ROTATIONS, improve=20):
+    # outlines as lists of (x, y) points. Returns the placements, the indices of the
+    # outlines that did not fit, the height the layout uses and the number of
+    # positions checked for collisions
+    parts = sorted((Part(i, outline, rotations) for i, outline in enumerate(outlines)),
+                   key=lambda part: part.area, reverse=True)
+    index = CollisionIndex()
+    placements, placed, unplaced = [], [], []
+    for part in parts:
+        result = place(part, index, placed, width, height)
+        if result is None:
+            unplaced.append(part.index)
+            continue
+        placements.append(result[0])
+        placed.append(result[1].bounds)
+        index.add(result[1])
+    # Local improvement: place the highest tool again among the others and keep
+    # the new position if the layout gets lower
+    parts = {part.index: part for part in parts}
+    for _ in range(improve if placements else 0):
+        top = max(range(len(placements)), key=lambda i: placed[i][3])
+        before = used_height(index.geometries)
+        placement, geometry = placements.pop(top), index.geometries[top]
+        del placed[top]
+        index.remove(top)
+        result = place(parts[placement['index']], index, placed, width, height)
+        improved = result is not None and max(used_height(index.geometries), result[1].bounds[3]) < before
+        if improved:
+            placement, geometry = result
+        placements.append(placement)
+        placed.append(geometry.bounds)
+        index.add(geometry)
+        if not improved:
+            break
+    return {'placements': sorted(placements, key=lambda placement: placement['index']),
+            'unplaced': sorted(unplaced),
+            'height': used_height(index.geometries),
+            'queries': index.queries}
+
+
+def placed_outline(outline, placement):
+    # The outline where the placement puts it
+    polygon = shapely.affinity.rotate(shapely.Polygon(outline), placement['rotation'], origin=(0, 0))
+    return shapely.get_coordinates(shapely.affinity.translate(polygon, placement['x'], placement['y'])).tolist()
@@ -0,0 +1,128 @@
+# Turns the arcs and lines of curves.json or curves.bin back into polylines and
+# writes them as SVG or DXF. All arcs are tessellated together in one numpy pass,
+# each with as few chords as keep it within the chord error tolerance.
+# Polylines are kept as (vertices, offsets): polyline i is
+# vertices[offsets[i]:offsets[i + 1]].
+# Usage: python tessellate.py <curves.json|curves.bin> <output.svg|output.dxf> [tolerance]
+import json
+import sys
+import numpy as np
+
+import binary_curves
+
+# Largest distance between an arc and its chords, in contour units
+TOLERANCE = 0.1
+
+
+def arc_sweeps(start_angles, end_angles, through=None):
+    # Signed sweep in degrees from each start to end angle, positive with growing
+    # angles. The shorter way round, or where given, the way that passes the
+    # through angle (NaN for none); both handle the wrap at +-180.
+    start_angles = np.asarray(start_angles, dtype=float)
+    forward = np.mod(np.asarray(end_angles, dtype=float) - start_angles, 360)
+    sweeps = np.where(forward <= 180, forward, forward - 360)
+    if through is not None:
+        through = np.asarray(through, dtype=float)
+        passes = np.mod(through - start_angles, 360) <= forward
+        sweeps = np.where(np.isnan(through), sweeps, np.where(passes, forward, forward - 360))
+    return sweeps
+
+
+def tessellate_arcs(xc, yc, r, start_angles, sweeps, tolerance=TOLERANCE):
+    # (vertices, offsets) of arcs given as arrays, starting at start_angles and
+    # turning by sweeps degrees
+    xc, yc, r, start_angles, sweeps = np.broadcast_arrays(*(np.asarray(values, dtype=float) for values in
+                                                            (xc, yc, r, start_angles, sweeps)))
+    # The sagitta r * (1 - cos(step / 2)) of every chord stays within tolerance
+    step = 2 * np.arccos(np.clip(1 - tolerance / np.maximum(r, 1e-12), -1, 1))
+    chords = np.maximum(np.ceil(np.abs(np.deg2rad(sweeps)) / step), 1).astype(np.int64)
+    offsets = np.zeros(len(chords) + 1, np.int64)
+    np.cumsum(chords + 1, out=offsets[1:])
+    arc = np.repeat(np.arange(len(chords)), chords + 1)
+    fraction = (np.arange(offsets[-1]) - offsets[arc]) / chords[arc]
+    angles = np.deg2rad(start_angles[arc] + sweeps[arc] * fraction)
+    vertices = np.stack([xc[arc] + r[arc] * np.cos(angles), yc[arc] + r[arc] * np.sin(angles)], axis=1)
+    return vertices, offsets
+
+
+def point_angles(points, indices, arcs):
+    return np.rad2deg(np.arctan2(points[indices, 1] - arcs['yc'], points[indices, 0] - arcs['xc']))
+
+
+def angle_distance(a, b):
+    return np.abs(np.mod(a - b + 180, 360) - 180)
+
+
+def arc_polylines(tables, tolerance=TOLERANCE):
+    # Arcs of curves tables as polylines running from their start to their end
+    # point. The sweep direction is the one that passes the contour point halfway
+    # between them; the fitted angles can be in either order.
+    arcs, points = tables['arcs'], tables['points']
+    start, end = arcs['start'].astype(np.int64), arcs['end'].astype(np.int64)
+    middle = (start + end) // 2
+    inner = (middle != start) & (middle != end)
+    through = np.where(inner, point_angles(points, middle, arcs), np.nan)
+    sweeps = arc_sweeps(arcs['start_angle'], arcs['end_angle'], through)
+    start_angles = arcs['start_angle'].astype(float)
+    reverse = angle_distance(point_angles(points, start, arcs), arcs['end_angle']) < \
+        angle_distance(point_angles(points, start, arcs), start_angles)
+    start_angles = np.where(reverse, start_angles + sweeps, start_angles)
+    sweeps = np.where(reverse, -sweeps, sweeps)
+    return tessellate_arcs(arcs['xc'], arcs['yc'], arcs['r'], start_angles, sweeps, tolerance)
+
+
+def polylines(tables, tolerance=TOLERANCE):
+    # Arcs and then lines of curves tables as one (vertices, offsets) pair
+    vertices, offsets = arc_polylines(tables, tolerance)
+    lines = tables['lines']
+    line_vertices = np.asarray(tables['points'], dtype=float)[
+        np.stack([lines['start'], lines['end']], axis=1).astype(np.int64).ravel()]
+    line_offsets = offsets[-1] + 2 * np.arange(1, len(lines) + 1)
+    return np.concatenate([vertices, line_vertices]), np.concatenate([offsets, line_offsets])
+
+
+def read_tables(path):
+    # Tables of curves.bin, or of curves.json in the same layout
+    if path.endswith('.bin'):
+        return binary_curves.read(path)
+    with open(path) as file:
+        return binary_curves.from_buffer(binary_curves.curves_bytes(json.load(file)))
+
+
+def svg_chunks(vertices, offsets, margin=10):
+    # SVG document in pieces, one path per polyline
+    minimum = vertices.min(axis=0) - margin if len(vertices) else np.zeros(2)
+    size = vertices.max(axis=0) + margin - minimum if len(vertices) else np.zeros(2)
+    yield ('<svg xmlns="http://www.w3.org/2000/svg" viewBox="{:.3f} {:.3f} {:.3f} {:.3f}">\n'
+           '<g fill="none" stroke="black">\n').format(*minimum, *size)
+    for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        yield '<path d="M' + ' L'.join(['{:.3f},{:.3f}'] * (end - start)).format(
+            *vertices[start:end].ravel().tolist()) + '"/>\n'
+    yield '</g>\n</svg>\n'
+
+
+def dxf_chunks(vertices, offsets):
+    # DXF R12 document in pieces, one POLYLINE per polyline on layer 0. DXF y points
+    # up, so y is mirrored to keep the outline the way it looks in the image.
+    yield '0\nSECTION\n2\nENTITIES\n'
+    for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        coordinates = vertices[start:end] * [1, -1]
+        yield '0\nPOLYLINE\n8\n0\n66\n1\n70\n0\n' + \
+            ('0\nVERTEX\n8\n0\n10\n{:.4f}\n20\n{:.4f}\n' * (end - start)).format(*coordinates.ravel().tolist()) + \
+            '0\nSEQEND\n'
+    yield '0\nENDSEC\n0\nEOF\n'
+
+
+def write(path, vertices, offsets):
+    # SVG or DXF by the extension of path, written as it is formatted
+    chunks = dxf_chunks(vertices, offsets) if path.lower().endswith('.dxf') else svg_chunks(vertices, offsets)
+    with open(path, 'w') as file:
+        file.writelines(chunks)
+
+
+def convert(source, target, tolerance=TOLERANCE):
+    write(target, *polylines(read_tables(source), tolerance))
+
+
+if __name__ == '__main__':
+    convert(sys.argv[1], sys.argv[2], *map(float, sys.argv[3:4]))
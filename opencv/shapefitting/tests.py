@@ -1,6 +1,23 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
-from fitting import get_non_arc_points
+import random
+from fitting import algebraic_circle, calc_line_deviation, circle_moments, contour_length, default_params, \
+    filter_arcs, filter_lines, find_arcs, find_lines, fit_contour, get_non_arc_points, get_points, point_distance, run, \
+    to_curves, LRUCache
 import numpy as np
+import binary_curves
+import fitting
+import nesting
+import tessellate
+import shapely
+from benchmark import GOLDEN_PATH, golden_outputs, synthetic_contour, synthetic_tools
+
+FIXTURE_PATH = os.path.dirname(os.path.abspath(__file__))
 
 
 class FittingTests(unittest.TestCase):
@@ -14,6 +31,342 @@ class FittingTests(unittest.TestCase):
         result = get_non_arc_points(arcs, points)
         self.assertEqual(result, expected_result)
 
+    def test_algebraic_circle(self):
+        angles = np.linspace(0, np.pi, 20)
+        points = np.stack([30 + 12 * np.cos(angles), -4 + 12 * np.sin(angles)], axis=1)
+        moments = circle_moments(points)
+        xc, yc, r, deviation = algebraic_circle((moments[-1] - moments[0]).tolist())
+        self.assertAlmostEqual(xc, 30)
+        self.assertAlmostEqual(yc, -4)
+        self.assertAlmostEqual(r, 12)
+        self.assertAlmostEqual(deviation, 0)
+        # Points on a line have no circle, rounding must not make one up
+        line = np.stack([np.linspace(-200, 200, 20), 150 + 0.3 * np.linspace(-200, 200, 20)], axis=1)
+        moments = circle_moments(line)
+        self.assertIsNone(algebraic_circle((moments[-1] - moments[0]).tolist()))
+
+    def test_find_arcs(self):
+        points = get_points(FIXTURE_PATH)
+        arcs = find_arcs(points, 0.1 * contour_length(points), 100)
+        self.assertEqual(sorted((arc['start'], arc['end']) for arc in arcs), [(2, 5), (17, 21), (23, 28)])
+        for arc in arcs:
+            self.assertEqual(arc['start_point'], points[arc['start']])
+            self.assertEqual(arc['end_point'], points[arc['end']])
+
+    def test_find_arcs_reference(self):
+        def reference(points, arc_length_threshold, arc_deviation_threshold):
+            # Least squares fit of every grown segment, as find_arcs did before the
+            # algebraic fit
+            arcs = []
+            start = 0
+            while True:
+                size = max(len(fitting.get_points_for_min_length(points[start:], arc_length_threshold)), 4)
+                for end in range(start + size - 1, len(points)):
+                    segment = np.array(points[start:end + 1])
+                    edges = np.linalg.norm(segment - np.roll(segment, 1, axis=0), axis=1)
+                    xc, yc, r, start_angle, end_angle, deviation = fitting.fit_circle(segment)
+                    arc = {'start': start, 'end': end, 'xc': xc, 'yc': yc, 'r': r, 'start_angle': start_angle,
+                           'end_angle': end_angle, 'distance': point_distance(points[start], points[end])}
+                    if not (abs(deviation) < arc_deviation_threshold and r < 5000 and
+                            fitting.arc_length(arc) < (np.sum(edges) - np.max(edges)) * 1.05):
+                        break
+                    arcs.append(arc)
+                else:
+                    return filter_arcs(arcs)
+                start += 1
+
+        def covered(arcs):
+            return {i for arc in arcs for i in range(arc['start'], arc['end'] + 1)}
+
+        # The algebraic fit accepts slightly different segments: the arcs may cover
+        # one point more or less, arcs over the same points have the same circle
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for points in [get_points(FIXTURE_PATH), get_points(FIXTURE_PATH, 20), synthetic_contour('circle', 100)]:
+                params = default_params(points)
+                expected = reference(points, params['arc_length_threshold'], params['arc_deviation_threshold'])
+                arcs = find_arcs(points, params['arc_length_threshold'], params['arc_deviation_threshold'])
+                self.assertLessEqual(len(covered(arcs) ^ covered(expected)), 1)
+                expected = {(arc['start'], arc['end']): arc for arc in expected}
+                for arc in arcs:
+                    match = expected.get((arc['start'], arc['end']))
+                    if match is not None:
+                        for key in ['xc', 'yc', 'r']:
+                            self.assertAlmostEqual(arc[key], match[key], places=3)
+
+    def test_fit_contour(self):
+        points = get_points(FIXTURE_PATH)
+        result = fit_contour(points, default_params(points))
+        self.assertEqual(len(result['arcs']), 3)
+        self.assertTrue(len(result['lines']) > 0)
+
+    def test_headless_imports(self):
+        # Importing and fitting without drawing must not load matplotlib
+        code = 'import sys, fitting; lazy = [m for m in ("matplotlib", "scipy", "shapely") if m in sys.modules]; ' \
+            'points = fitting.get_points("."); fitting.fit_contour(points, fitting.default_params(points)); ' \
+            'print(lazy, "matplotlib" in sys.modules)'
+        output = subprocess.run([sys.executable, '-c', code], cwd=FIXTURE_PATH,
+                                check=True, capture_output=True, text=True).stdout
+        self.assertEqual(output.strip(), '[] False')
+
+    def test_opencv_modules(self):
+        # Modules called cache and instrument elsewhere on the path are left alone
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['cache', 'instrument']:
+                with open(os.path.join(directory, name + '.py'), 'w') as file:
+                    file.write('UNRELATED = True\n')
+            code = 'import sys, cache, fitting; ' \
+                'print(cache.UNRELATED, fitting.LRUCache.__module__, fitting.timed.__module__, "instrument" in sys.modules)'
+            output = subprocess.run([sys.executable, '-c', code], cwd=FIXTURE_PATH, check=True, capture_output=True,
+                                    text=True, env=dict(os.environ, PYTHONPATH=directory)).stdout
+        self.assertEqual(output.split(), ['True', 'foamsizer_cache', 'foamsizer_instrument', 'False'])
+        # With the opencv directory on the path the scripts share one module
+        code = 'import sys; sys.path.append(".."); import fitting, instrument; print(fitting.timed is instrument.timed)'
+        output = subprocess.run([sys.executable, '-c', code], cwd=FIXTURE_PATH,
+                                check=True, capture_output=True, text=True).stdout
+        self.assertEqual(output.strip(), 'True')
+
+    def test_golden_outputs(self):
+        with open(GOLDEN_PATH) as file:
+            golden = json.load(file)
+        outputs = golden_outputs()
+        self.assertEqual(outputs.keys(), golden.keys())
+        for name, expected in golden.items():
+            curves = outputs[name]
+            np.testing.assert_allclose([[p['x'], p['y']] for p in curves['points']],
+                                       [[p['x'], p['y']] for p in expected['points']], err_msg=name)
+            self.assertEqual([(a['start'], a['end']) for a in curves['arcs']],
+                             [(a['start'], a['end']) for a in expected['arcs']], name)
+            for arc, expected_arc in zip(curves['arcs'], expected['arcs']):
+                for key in ['xc', 'yc', 'r', 'start_angle', 'end_angle']:
+                    self.assertAlmostEqual(arc[key], expected_arc[key], places=4, msg=name)
+            self.assertEqual(curves['lines'], expected['lines'], name)
+
+    def test_synthetic_contour(self):
+        for shape in ['circle', 'rounded_rectangle', 'plier']:
+            points = synthetic_contour(shape, 300)
+            self.assertEqual(len(points), 300)
+            params = default_params(points)
+            arcs = find_arcs(points, params['arc_length_threshold'], params['arc_deviation_threshold'])
+            self.assertTrue(len(arcs) > 0, shape)
+
+    def test_filter_overlaps(self):
+        def reference(candidates, size, interval):
+            # Quadratic pop-and-remove selection the filters must reproduce
+            clean = []
+            candidates = sorted(candidates, key=size)
+            while len(candidates) > 0:
+                kept = candidates.pop()
+                for remaining in candidates[:]:
+                    if (interval(remaining)[0] <= interval(kept)[0] and interval(remaining)[1] > interval(kept)[0]) or \
+                            (interval(remaining)[0] < interval(kept)[1] and interval(remaining)[0] >= interval(kept)[0]):
+                        candidates.remove(remaining)
+                clean.append(kept)
+            return clean
+
+        rng = random.Random(0)
+        for _ in range(500):
+            arcs = []
+            for i in range(rng.randint(0, 30)):
+                start = rng.randint(0, 25)
+                arcs.append({'start': start, 'end': start + rng.randint(-2, 8), 'distance': rng.randint(0, 5), 'id': i})
+            lines = [{'start': (0, 0, arc['start']), 'end': (0, 0, arc['end']), 'length': arc['distance'], 'id': arc['id']}
+                     for arc in arcs]
+            self.assertEqual(filter_arcs(arcs),
+                             reference(arcs, lambda x: x['distance'], lambda x: (x['start'], x['end'])))
+            self.assertEqual(filter_lines(lines),
+                             reference(lines, lambda x: x['length'], lambda x: (x['start'][2], x['end'][2])))
+
+    def test_find_lines(self):
+        def reference(points, arcs, line_deviation_threshold):
+            # Grows every segment point by point and filters them all
+            lines = []
+            for group in get_non_arc_points(arcs, points):
+                for i in range(len(group) - 1):
+                    for j in range(i + 1, len(group)):
+                        line = (group[i][0], group[i][1], group[j][0], group[j][1])
+                        deviation = calc_line_deviation(line, group[i:j + 1])
+                        if not deviation < line_deviation_threshold:
+                            break
+                        lines.append({'start': group[i], 'end': group[j], 'deviation': deviation,
+                                      'length': point_distance(group[i], group[j])})
+            return filter_lines(lines)
+
+        rng = random.Random(0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for _ in range(100):
+                size = rng.randint(2, 50)
+                if rng.random() < 0.5:
+                    # Noisy straight runs, with repeated points and equal lengths
+                    points = [(float(i * 3 + rng.randint(-2, 2)), float(rng.randint(-2, 2))) for i in range(size)]
+                else:
+                    points = [(rng.uniform(0, 100), rng.uniform(0, 100)) for _ in range(size)]
+                arcs = [{'start': 5, 'end': 9}] if size > 10 else []
+                for threshold in [1, 5, 20]:
+                    self.assertEqual(find_lines(points, arcs, threshold), reference(points, arcs, threshold))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.get('a', lambda: 1), 1)
+        self.assertEqual(cache.get('b', lambda: 2), 2)
+        self.assertEqual(cache.get('a', lambda: 3), 1)
+        # b is the least recently used one now
+        cache.get('c', lambda: 4)
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+
+    def test_contour_cache(self):
+        with open(FIXTURE_PATH + '/contour.txt') as file:
+            text = file.read()
+        path = tempfile.mkdtemp()
+        try:
+            with open(path + '/contour.txt', 'w') as file:
+                file.write(text)
+            for offset in [0, 20]:
+                points = get_points(path, offset)
+                self.assertEqual(points, get_points(FIXTURE_PATH, offset))
+                expected = json.loads(json.dumps(points))
+                # Callers can change their copy without touching the cache
+                points.pop()
+                if offset:
+                    points[0][0] += 1
+                self.assertEqual(json.loads(json.dumps(get_points(path, offset))), expected)
+            run(path, 20)
+            with open(path + '/curves.json') as file:
+                curves = file.read()
+            os.remove(path + '/curves.json')
+            run(path, 20)
+            with open(path + '/curves.json') as file:
+                self.assertEqual(file.read(), curves)
+            # Other thresholds are fitted again
+            contour = fitting.read_contour(path)
+            points = get_points(path, 20)
+            params = dict(default_params(points), line_deviation_threshold=1)
+            result = fit_contour(points, params)
+            self.assertEqual(fitting.offset_curves(contour, 20, params),
+                             to_curves(result['lines'], result['arcs'], points))
+            self.assertNotEqual(fitting.offset_curves(contour, 20, params), json.loads(curves))
+            # New content is parsed again
+            with open(path + '/contour.txt', 'w') as file:
+                file.write(text.replace('348', '349', 1))
+            self.assertEqual(get_points(path)[0][0], 349)
+        finally:
+            shutil.rmtree(path)
+
+    def test_binary_curves(self):
+        points = get_points(FIXTURE_PATH)
+        result = fit_contour(points, default_params(points))
+        curves = to_curves(result['lines'], result['arcs'], points)
+        path = tempfile.mkdtemp()
+        try:
+            with open(path + '/curves.json', 'w') as file:
+                json.dump(curves, file)
+            binary_curves.convert(path + '/curves.json', path + '/curves.bin')
+            tables = binary_curves.read(path + '/curves.bin')
+            # Written from the fit's arrays it is the same file
+            self.assertEqual(binary_curves.to_bytes(*fitting.curves_tables(result['lines'], result['arcs'], points)),
+                             bytes(np.fromfile(path + '/curves.bin', np.uint8)))
+            # Memory mapped views, not copies
+            self.assertFalse(tables['points'].flags.owndata)
+            self.assertEqual(tables['points'].tolist(), [list(point) for point in points])
+            self.assertEqual(tables['lines']['start'].tolist(), [line['start'] for line in curves['lines']])
+            binary_curves.convert(path + '/curves.bin', path + '/converted.json')
+            with open(path + '/converted.json') as file:
+                self.assertEqual(json.load(file), curves)
+            # A contour only in the binary format is read like contour.txt
+            binary_curves.convert(FIXTURE_PATH + '/contour.txt', path + '/contour.bin')
+            self.assertEqual(get_points(path), points)
+            self.assertEqual(get_points(path, 20), get_points(FIXTURE_PATH, 20))
+            binary_curves.convert(path + '/contour.bin', path + '/contour.txt')
+            self.assertEqual(binary_curves.read_contour_txt(path + '/contour.txt').tolist(),
+                             [list(point) for point in points])
+            binary_curves.write(path + '/small.bin', points, float_type=np.float32)
+            self.assertEqual(binary_curves.read(path + '/small.bin', mmap=False)['points'].dtype, np.float32)
+        finally:
+            shutil.rmtree(path)
+
+    def test_offset_sweep(self):
+        self.assertEqual(fitting.sweep_offsets(0, 20, 10), [0, 10, 20])
+        self.assertEqual(fitting.sweep_offsets(-1, 0.5, 0.5), [-1, -0.5, 0, 0.5])
+        path = tempfile.mkdtemp()
+        try:
+            shutil.copy(FIXTURE_PATH + '/contour.txt', path)
+            self.assertEqual(fitting.sweep(path, 0, 20, 10, processes=2), [0, 10, 20])
+            digest, results = binary_curves.read_sweep(path + '/curves_sweep.bin')
+            self.assertEqual(sorted(results), [0, 10, 20])
+            for offset in [0, 10, 20]:
+                points = get_points(FIXTURE_PATH, offset)
+                result = fit_contour(points, default_params(points))
+                self.assertEqual(binary_curves.tables_to_curves(results[offset]),
+                                 json.loads(json.dumps(to_curves(result['lines'], result['arcs'], points))))
+            # A changed contour is fitted again instead of read from the stale sweep
+            with open(path + '/contour.txt') as file:
+                text = file.read()
+            with open(path + '/contour.txt', 'w') as file:
+                file.write(text.replace('348', '349', 1))
+            run(path, 10)
+            with open(path + '/curves.json') as file:
+                curves = json.load(file)
+            self.assertNotEqual(curves, binary_curves.tables_to_curves(results[10]))
+            self.assertEqual(curves, json.loads(json.dumps(fitting.offset_curves(fitting.read_contour(path), 10))))
+        finally:
+            shutil.rmtree(path)
+
+    def test_nesting(self):
+        bar = [(0, 0), (100, 0), (100, 20), (0, 20)]
+        square = [(0, 0), (30, 0), (30, 30), (0, 30)]
+        # The bar only fits the narrow tray turned upright, the last square not at all
+        layout = nesting.nest([bar, square, square, square, [(0, 0), (200, 0), (0, 5)]], 60, 120)
+        self.assertEqual(layout['unplaced'], [4])
+        self.assertIn(layout['placements'][0]['rotation'], (90, 270))
+        outlines = [shapely.Polygon(nesting.placed_outline([bar, square, square, square][placement['index']], placement))
+                    for placement in layout['placements']]
+        for i, outline in enumerate(outlines):
+            self.assertTrue(shapely.box(0, 0, 60, 120).buffer(1e-6).contains(outline))
+            for other in outlines[i + 1:]:
+                self.assertAlmostEqual(outline.intersection(other).area, 0)
+        self.assertAlmostEqual(layout['height'], 100)
+        tools = synthetic_tools(30)
+        layout = nesting.nest(tools, 300, 1000)
+        self.assertEqual(layout['unplaced'], [])
+        outlines = [shapely.Polygon(nesting.placed_outline(tools[placement['index']], placement))
+                    for placement in layout['placements']]
+        self.assertEqual(len(shapely.STRtree(outlines).query(outlines, predicate='overlaps')[0]), 0)
+
+    def test_tessellate(self):
+        # Shortest way round across +-180, or the way through the given angle
+        self.assertEqual(tessellate.arc_sweeps([170, -170, 10, 0, 0], [-170, 170, -10, 90, 90],
+                                               [np.nan, np.nan, 0, 45, 180]).tolist(),
+                         [20, -20, -20, 90, -270])
+        vertices, offsets = tessellate.tessellate_arcs([0, 5], [0, 5], [100, 3], [0, 170], [90, 20], 0.1)
+        self.assertEqual(len(offsets), 3)
+        quarter = vertices[offsets[0]:offsets[1]]
+        np.testing.assert_allclose(quarter[[0, -1]], [[100, 0], [0, 100]], atol=1e-9)
+        middles = (quarter[1:] + quarter[:-1]) / 2
+        self.assertLessEqual((100 - np.hypot(*middles.T)).max(), 0.1)
+        points = get_points(FIXTURE_PATH)
+        result = fit_contour(points, default_params(points))
+        curves = json.loads(json.dumps(to_curves(result['lines'], result['arcs'], points)))
+        path = tempfile.mkdtemp()
+        try:
+            with open(path + '/curves.json', 'w') as file:
+                json.dump(curves, file)
+            tables = tessellate.read_tables(path + '/curves.json')
+            vertices, offsets = tessellate.polylines(tables)
+            # Every polyline runs from the start to the end point of its curve
+            for i, curve in enumerate(curves['arcs'] + curves['lines']):
+                ends = np.array([points[curve['start']], points[curve['end']]])
+                distances = np.linalg.norm(vertices[[offsets[i], offsets[i + 1] - 1], None] - ends, axis=2)
+                self.assertLess(distances.trace(), distances[::-1].trace())
+            tessellate.convert(path + '/curves.json', path + '/curves.svg')
+            tessellate.convert(path + '/curves.json', path + '/curves.dxf')
+            with open(path + '/curves.svg') as file:
+                self.assertEqual(file.read().count('<path'), len(offsets) - 1)
+            with open(path + '/curves.dxf') as file:
+                dxf = file.read()
+            self.assertEqual(dxf.count('POLYLINE'), len(offsets) - 1)
+            self.assertEqual(dxf.count('VERTEX'), len(vertices))
+        finally:
+            shutil.rmtree(path)
+
     def test_function2(self):
         # Test code for function 2
         pass
@@ -0,0 +1,60 @@
+# Interactive matplotlib view of the contour fitting, imported by fitting.run only when drawing
+import matplotlib.pyplot as plt
+import numpy as np
+from functools import partial
+from matplotlib.widgets import Button
+
+from fitting import curves_tables, fit_contour, lines_to_file
+from tessellate import arc_polylines
+
+
+def main_plot(ax, main_image, points):
+    ax.clear()
+    height, width = main_image.shape[:2]
+    ax.imshow(main_image, extent=[0, width/1.1811, height/1.1811, 0])
+    # First point in blue
+    ax.plot(*points[0], 'bo')
+    ax.plot(*zip(*points[1:]), 'ro')
+
+
+def draw_all_arcs(ax, arcs, points):
+    # All arcs in one plot call, the polylines separated by NaN points
+    if not arcs:
+        return
+    table_points, table_arcs, _ = curves_tables([], arcs, points)
+    vertices, offsets = arc_polylines({'points': table_points, 'arcs': table_arcs})
+    vertices = np.insert(vertices, offsets[1:-1], np.nan, axis=0)
+    ax.plot(vertices[:, 0], vertices[:, 1], 'g-')
+
+
+def draw_line(ax, line):
+    x_fit = [line['start'][0], line['end'][0]]
+    y_fit = [line['start'][1], line['end'][1]]
+    ax.plot(x_fit, y_fit, 'b-')
+
+
+def draw_all_lines(ax, lines):
+    for line in lines:
+        draw_line(ax, line)
+
+
+def callback(event, ax=None, main_image=None, path='', points=[], params={}):
+    result = fit_contour(points, params)
+    main_plot(ax, main_image, points)
+    draw_all_arcs(ax, result['arcs'], points)
+    draw_all_lines(ax, result['lines'])
+    plt.draw()
+    lines_to_file(path, result['lines'], result['arcs'], points)
+
+
+def show(path, points, params):
+    main_image = plt.imread(path + '/main.png')
+    fig, ax = plt.subplots()
+    plt.subplots_adjust(bottom=0.2)
+    main_plot(ax, main_image, points)
+    plt.draw()
+    axnext = fig.add_axes([0.7, 0.05, 0.1, 0.075])
+    bnext = Button(axnext, 'Next')
+    bnext.on_clicked(partial(callback, ax=ax, main_image=main_image,
+                             path=path, points=points, params=params))
+    plt.show()
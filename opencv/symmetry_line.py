@@ -1,8 +1,15 @@
 import cv2
+import numpy as np
+import os
 import sys
+from cache import cached_file_result
+from instrument import stage, timed
 
+# Cached results are reused while this file stays the same
+SOURCES = (os.path.abspath(__file__),)
 
-def overlay_image(img, offset):
+
+def overlay_image(img, half, offset):
     left = img[:, :half + offset]
     right = img[:, half + offset:]
     # Add white pixels to the right side
@@ -17,26 +24,150 @@ def overlay_image(img, offset):
     return cv2.absdiff(left, right)
 
 
-if __name__ == '__main__':
-    path = sys.argv[1]
+def column_sums(diff):
+    # Prefix sums over columns, so columns [i, j) sum to sums[j] - sums[i]
+    totals = diff.reshape(diff.shape[0], diff.shape[1], -1).sum(axis=(0, 2), dtype=np.int64)
+    return np.concatenate(([0], np.cumsum(totals)))
+
+
+def split_costs(img):
+    # Returns cost(split), the same value as overlay_image(img, half, split - half).sum(),
+    # but only the overlapping columns are compared and the white padding comes from prefix sums
+    width = img.shape[1]
+    white = column_sums(cv2.absdiff(img, np.full_like(img, 255)))
+    mirror = []
+
+    def cost(split):
+        right_width = width - split
+        if right_width <= split:
+            # The right side is compared unflipped, left columns past it against white
+            overlap = cv2.absdiff(img[:, :right_width], img[:, split:])
+            return int(overlap.sum(dtype=np.int64)) + int(white[split] - white[right_width])
+        # The flipped right side lines up with the mirrored image, the padded left part is white
+        if not mirror:
+            mirror.append(column_sums(cv2.absdiff(img, cv2.flip(img, 1))))
+        return int(mirror[0][split] + white[right_width] - white[split])
+    return cost
+
+
+def best_split(costs, splits):
+    # Lowest cost, ties go to the largest split like the original offset sweep
+    best = min(range(len(splits)), key=lambda i: (costs[i], -splits[i]))
+    return splits[best]
+
+
+@timed()
+def find_symmetry_axis(img, search=200, scale=4, candidates=3):
+    # Coarse-to-fine search for the split column of the best overlay. The whole
+    # offset range is swept on a downsampled grayscale copy and the best coarse
+    # minima are refined at full resolution. Returns half - best_offset like the
+    # original sweep and a confidence in [0, 1] of how much the best coarse cost
+    # stands out from the median.
+    width = img.shape[1]
+    half = width // 2
+    first = max(half - search + 1, 1)
+    last = min(half + search, width - 1)
+    windows = [(first, last)]
+    confidence = 0.0
+    if scale > 1 and last - first > 4 * scale:
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, (max(width // scale, 1), max(gray.shape[0] // scale, 1)),
+                           interpolation=cv2.INTER_AREA)
+        coarse_cost = split_costs(small)
+        coarse_splits = list(range(max(first // scale, 1), min(last // scale + 1, small.shape[1])))
+        coarse = np.array([coarse_cost(split) for split in coarse_splits], dtype=np.float64)
+        # Refine around the lowest local minima of the coarse sweep
+        order = np.argsort(coarse, kind='stable')
+        minima = [i for i in order if (i == 0 or coarse[i] <= coarse[i - 1]) and
+                  (i == len(coarse) - 1 or coarse[i] <= coarse[i + 1])][:candidates]
+        windows = [(max(coarse_splits[i] * scale - 2 * scale, first),
+                    min(coarse_splits[i] * scale + 2 * scale, last)) for i in minima]
+        median = np.median(coarse)
+        if median > 0:
+            confidence = float(1 - coarse[order[0]] / median)
+    full_cost = split_costs(img)
+    splits = sorted(set(split for start, end in windows for split in range(start, end + 1)))
+    costs = [full_cost(split) for split in splits]
+    best_offset = best_split(costs, splits) - half
+    return half - best_offset, confidence
+
+
+def foreground_mask(img, threshold=240):
+    # Everything darker than the white scanner background
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return (gray < threshold).astype(np.float32)
+
+
+def mirror_scores(mask):
+    # Fraction of the foreground that is mirrored onto foreground for every axis at once.
+    # Mirroring row y about x = k / 2 overlaps mask[y, x] with mask[y, k - x], so the
+    # scores are the row-wise autoconvolutions summed over rows, done with one FFT.
+    width = mask.shape[1]
+    total = mask.sum()
+    if total == 0:
+        return np.zeros(2 * width - 1)
+    size = 2 * width
+    spectrum = np.fft.rfft(mask, size, axis=1)
+    scores = np.fft.irfft((spectrum * spectrum).sum(axis=0), size)[:2 * width - 1]
+    return scores / total
+
+
+def best_mirror_axis(mask, angle):
+    # Rotates the mask about its center and returns (axis, score, rotation)
+    height, width = mask.shape
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), float(angle), 1)
+    rotated = mask if angle == 0 else cv2.warpAffine(
+        mask, rotation, (width, height), flags=cv2.INTER_NEAREST)
+    scores = mirror_scores(rotated)
+    k = int(np.argmax(scores))
+    return k / 2, float(scores[k]), rotation
+
+
+@timed()
+def find_symmetry_axis_fft(img, max_angle=0, angle_step=1, threshold=240, scale=4):
+    # Mirror axis of the foreground mask, optionally tilted by up to max_angle degrees
+    # for tools that were scanned slightly rotated. The tilt is picked on a mask
+    # downsampled by scale and the axis is located at full resolution. Returns the x
+    # where the axis crosses the middle row, the tilt in degrees and the mirrored
+    # foreground fraction.
+    mask = foreground_mask(img, threshold)
+    height, width = mask.shape
+    angle = 0.0
+    if max_angle > 0:
+        small = cv2.resize(mask, (max(width // scale, 1), max(height // scale, 1)),
+                           interpolation=cv2.INTER_AREA)
+        angles = np.arange(-max_angle, max_angle + angle_step / 2, angle_step)
+        angle = float(max(angles, key=lambda angle: best_mirror_axis(small, angle)[1]))
+    axis, score, rotation = best_mirror_axis(mask, angle)
+    # Map the vertical axis of the rotated mask back into image coordinates
+    inverse = cv2.invertAffineTransform(rotation)
+    top, bottom = (inverse @ np.array([[axis, axis], [0, height], [1, 1]])).T
+    t = (height / 2 - top[1]) / (bottom[1] - top[1])
+    return float(top[0] + t * (bottom[0] - top[0])), angle, score
+
+
+@timed()
+def find_symmetry_line(path, mode='overlay', max_angle=0):
     imgpath = path + "/main.png"
+    return cached_file_result('symmetry_line', imgpath, [mode, max_angle], SOURCES,
+                              lambda: symmetry_axis_x(imgpath, mode, max_angle))
+
+
+def symmetry_axis_x(imgpath, mode='overlay', max_angle=0):
+    with stage('imread'):
+        img = cv2.imread(imgpath)
+    if mode == 'fft':
+        x, angle, score = find_symmetry_axis_fft(img, max_angle)
+        return int(round(x))
 
     # Cut the image in half, flip the right side and subtract it from the left side
-    img = cv2.imread(imgpath)
-    fitting = True
-    height, width, _ = img.shape
-    half = width // 2
-    offset = 200
-    old_sum = None
-    sums = []
-    offsets = []
-    while offset > -200:
-        diff = overlay_image(img, offset)
-        # Get the diff sum
-        diff_sum = diff.sum()
-        sums.append(diff_sum)
-        offsets.append(offset)
-        offset -= 1
-    # Find the best offset
-    best_offset = offsets[sums.index(min(sums))]
-    print(half - best_offset)
+    axis, confidence = find_symmetry_axis(img)
+    return axis
+
+
+if __name__ == '__main__':
+    # symmetry_line.py <path> [fft [max_angle]]
+    path = sys.argv[1]
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'overlay'
+    max_angle = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+    print(find_symmetry_line(path, mode, max_angle))
@@ -1,67 +1,165 @@
+import argparse
 import cv2
-import numpy as np
-from matplotlib import pyplot as plt
+import json
+import os
 import sys
+from functools import partial
+from multiprocessing import Pool
 
-# Read args
-image_path = sys.argv[1]
-# Load the image
-# image_path = "C:/Users/timal/Documents/Programmieren/foamsizer/opencv/img/caliper.jpg"
-image = cv2.imread(image_path)
-
-# Convert to grayscale
-gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-# Apply GaussianBlur to reduce noise
-blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-
-# Use adaptive thresholding
-thresh = cv2.adaptiveThreshold(
-    blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 135, 2)
-
-# Use morphological operations to close gaps
-kernel = np.ones((25, 25), np.uint8)
-morphed = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
-
-# Find contours
-contours, _ = cv2.findContours(
-    morphed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-# Select the contour with the largest area
-largest_contour = max(contours, key=cv2.contourArea)
-
-# Draw the largest contour on the original image
-contour_image = image.copy()
-cv2.drawContours(contour_image, [largest_contour], -1, (0, 255, 0), 2)
-
-# Draw an approximated contour around the largest contour
-epsilon = 0.0025 * cv2.arcLength(largest_contour, True)
-approx = cv2.approxPolyDP(largest_contour, epsilon, True)
-cv2.drawContours(contour_image, [approx], -1, (0, 0, 255), 2)
-
-# Print approx points
-approx_points = approx.tolist()
-for point in approx_points:
-    print(str(point[0][0]) + "," + str(point[0][1]))
+import instrument
+import pipeline
+from cache import cached_file_result
+from pipeline import CONTOUR_PARAMS, Scan, split_tools, stage_timings
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+# Cached results are reused while these files stay the same
+SOURCES = (os.path.abspath(__file__), pipeline.__file__)
+
+
+@instrument.timed()
+def analyze_image(image_path, debug=False, scale=1, roi=None):
+    scan = Scan(path=image_path, params=dict(CONTOUR_PARAMS, scale=scale), roi=roi)
+    approx = scan.approx
+
+    stages = {'blurred': scan.blurred, 'thresh': scan.thresh, 'morphed': scan.morphed}
+    if debug:
+        # Draw the largest and the approximated contour on the original image
+        contour_image = scan.image.copy()
+        cv2.drawContours(contour_image, [scan.largest_contour], -1, (0, 255, 0), 2)
+        cv2.drawContours(contour_image, [approx], -1, (0, 0, 255), 2)
+        stages['contour_image'] = contour_image
+    return approx, stages
+
+
+def plot_stages(stages):
+    from matplotlib import pyplot as plt
+
+    # Display the original image, thresholded image, and contour image
+    plt.figure(figsize=(15, 5))
+
+    plt.subplot(1, 4, 1)
+    plt.title("Original Image")
+    plt.imshow(stages['blurred'], cmap='gray')
+
+    plt.subplot(1, 4, 2)
+    plt.title("Thresholded Image")
+    plt.imshow(stages['thresh'], cmap='gray')
+
+    plt.subplot(1, 4, 3)
+    plt.title("Closed Contours")
+    plt.imshow(stages['morphed'], cmap='gray')
+
+    plt.subplot(1, 4, 4)
+    plt.title("Largest Contour")
+    plt.imshow(cv2.cvtColor(stages['contour_image'], cv2.COLOR_BGR2RGB))
+
+    plt.show()
+
+
+@instrument.timed()
+def contour_points(image_path, scale=1, roi=None):
+    # Approximated contour points as [x, y] pairs
+    params = dict(CONTOUR_PARAMS, scale=scale)
+    return cached_file_result('contour_points', image_path, [params, roi], SOURCES,
+                              lambda: Scan(path=image_path, params=params, roi=roi).points)
+
+
+@instrument.timed()
+def analyze_result(image_path, scale=1, candidates=3, roi=None):
+    # Everything about one image in a single JSON-ready message: the approximated
+    # contour and its area, how long every stage took and the largest candidates
+    scan = Scan(path=image_path, params=dict(CONTOUR_PARAMS, scale=scale), roi=roi)
+    timings = stage_timings(scan)
+    height, width = scan.image.shape[:2]
+    return {'image': image_path, 'width': width, 'height': height,
+            'contour': scan.points, 'area': float(cv2.contourArea(scan.largest_contour)),
+            'roi': list(scan.bounds), 'timings': timings, 'candidates': scan.candidates(candidates)}
+
+
+def image_paths(inputs):
+    # Expand directories into the images they contain
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.append(path)
+    return paths
+
+
+def batch_result(image_path, scale=1, roi=None):
+    try:
+        return {'image': image_path, 'points': contour_points(image_path, scale, roi)}
+    except Exception as e:
+        return {'image': image_path, 'error': '{}: {}'.format(type(e).__name__, e)}
+
+
+def analyze_batch(paths, processes=None, scale=1, roi=None):
+    # Yields one result per image in completion order, using one process per core by default
+    with Pool(processes or os.cpu_count()) as pool:
+        yield from pool.imap_unordered(partial(batch_result, scale=scale, roi=roi), paths)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Find the approximated contour of the largest object in an image')
+    parser.add_argument('images', nargs='+',
+                        help='image path, or images and directories with --batch')
+    parser.add_argument('--batch', action='store_true',
+                        help='print one JSON line per image as soon as it is done')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--scale', type=float, default=1,
+                        help='threshold and close on a copy resized by this factor')
+    parser.add_argument('--roi', type=int, nargs=4, metavar=('X', 'Y', 'WIDTH', 'HEIGHT'),
+                        help='only search this area, points stay in full image coordinates')
+    parser.add_argument('--debug', action='store_true',
+                        help='build the figure with the intermediate stages')
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON message with the contour, stage timings and candidates')
+    parser.add_argument('--candidates', type=int, default=3,
+                        help='number of largest contours listed with --json')
+    parser.add_argument('--tools', metavar='OUTPUT_DIR',
+                        help='write a folder with main.png, contour.txt and curves.json for every tool in the image')
+    parser.add_argument('--offset', type=int, default=20, help='offset the --tools curves are fitted with')
+    parser.add_argument('--border', action='store_true',
+                        help='keep --tools objects touching the image edge')
+    parser.add_argument('--profile', nargs='?', const='-', metavar='PATH',
+                        help='write per-stage timings as JSON to PATH, stderr without one')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='add the peak traced memory of every stage to the timings')
+    parser.add_argument('--cprofile', metavar='PATH', help='dump a cProfile of the run to PATH')
+    args = parser.parse_args()
+    if args.profile or args.profile_memory or args.cprofile:
+        instrument.enable(args.profile or '-', args.cprofile, args.profile_memory)
+
+    if args.batch:
+        for result in analyze_batch(image_paths(args.images), args.processes, args.scale, args.roi):
+            print(json.dumps(result))
+            sys.stdout.flush()
+        sys.exit()
+
+    if args.tools:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shapefitting'))
+        import fitting
+        params = dict(CONTOUR_PARAMS, scale=args.scale)
+        tools = split_tools(args.images[0], args.tools, params, workers=args.processes, border=args.border,
+                            fit=partial(fitting.run, offset=args.offset))
+        sys.stdout.write(json.dumps([{'path': tool['path'], 'bounds': tool['bounds'], 'area': tool['area']}
+                                     for tool in tools]) + '\n')
+        sys.stdout.flush()
+        sys.exit()
+
+    if args.json:
+        sys.stdout.write(json.dumps(analyze_result(args.images[0], args.scale, args.candidates, args.roi)) + '\n')
+        sys.stdout.flush()
+        sys.exit()
+
+    approx, stages = analyze_image(args.images[0], args.debug, args.scale, args.roi)
+
+    # Print approx points, written at once
+    sys.stdout.write(''.join('{},{}\n'.format(*point[0]) for point in approx.tolist()))
     sys.stdout.flush()
 
-# Display the original image, thresholded image, and contour image
-plt.figure(figsize=(15, 5))
-
-plt.subplot(1, 4, 1)
-plt.title("Original Image")
-plt.imshow(cv2.cvtColor(blurred, cv2.COLOR_BGR2RGB))
-
-plt.subplot(1, 4, 2)
-plt.title("Thresholded Image")
-plt.imshow(thresh, cmap='gray')
-
-plt.subplot(1, 4, 3)
-plt.title("Closed Contours")
-plt.imshow(morphed, cmap='gray')
-
-plt.subplot(1, 4, 4)
-plt.title("Largest Contour")
-plt.imshow(cv2.cvtColor(contour_image, cv2.COLOR_BGR2RGB))
-
-# plt.show()
+    if args.debug:
+        plot_stages(stages)
@@ -0,0 +1,345 @@
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import cv2
+import numpy as np
+import cache
+import calibration
+import instrument
+import remove_bg
+from pipeline import BACKGROUND_PARAMS, CONTOUR_PARAMS, PIXELS_PER_UNIT, STAGES, Scan, analyze_and_remove_background, \
+    downscale_accuracy, split_tools
+from test import analyze_batch, analyze_result, contour_points, image_paths
+from symmetry_line import find_symmetry_axis, find_symmetry_axis_fft, overlay_image, split_costs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aws_lambda'))
+import lambda_function  # noqa: E402
+import local  # noqa: E402
+
+IMAGE_PATH = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'shapefitting', 'main.png')
+
+
+class SymmetryLineTests(unittest.TestCase):
+    def test_split_costs(self):
+        img = np.random.default_rng(0).integers(0, 256, (20, 31, 3), dtype=np.uint8)
+        half = img.shape[1] // 2
+        cost = split_costs(img)
+        for split in range(1, img.shape[1]):
+            self.assertEqual(cost(split), overlay_image(img, half, split - half).sum())
+
+    def test_find_symmetry_axis(self):
+        img = cv2.imread(IMAGE_PATH)
+        half = img.shape[1] // 2
+        # Original full sweep over all offsets
+        offsets = list(range(200, -200, -1))
+        sums = [overlay_image(img, half, offset).sum() for offset in offsets]
+        expected = half - offsets[sums.index(min(sums))]
+        axis, confidence = find_symmetry_axis(img)
+        self.assertEqual(axis, expected)
+        self.assertTrue(0 <= confidence <= 1)
+
+    def test_find_symmetry_axis_fft(self):
+        img = np.full((600, 500, 3), 255, np.uint8)
+        # Symmetric about x = 260
+        polygon = np.array([[230, 100], [290, 100], [330, 300], [300, 500], [220, 500], [190, 300]])
+        cv2.fillPoly(img, [polygon], (20, 20, 20))
+        x, angle, score = find_symmetry_axis_fft(img)
+        self.assertEqual((x, angle), (260, 0))
+        self.assertGreater(score, 0.99)
+        rotation = cv2.getRotationMatrix2D((250, 300), 4, 1)
+        rotated = cv2.warpAffine(img, rotation, (500, 600), borderValue=(255, 255, 255))
+        x, angle, score = find_symmetry_axis_fft(rotated, max_angle=6)
+        self.assertAlmostEqual(x, 260, delta=1)
+        self.assertEqual(angle, -4)
+        self.assertGreater(score, 0.99)
+
+
+class AnalyzeImageTests(unittest.TestCase):
+    def test_analyze_batch(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for i, size in enumerate([(100, 60), (80, 120)]):
+                img = np.full((300, 300, 3), 255, np.uint8)
+                cv2.rectangle(img, (50, 50), (50 + size[0], 50 + size[1]), (20, 20, 20), -1)
+                cv2.imwrite(os.path.join(directory, '{}.png'.format(i)), img)
+            missing = os.path.join(directory, 'missing.png')
+            paths = image_paths([directory, missing])
+            results = {result['image']: result for result in analyze_batch(paths, 2)}
+            self.assertEqual(len(results), 3)
+            self.assertIn('error', results[missing])
+            for path in paths[:2]:
+                self.assertEqual(results[path]['points'], contour_points(path))
+
+    def test_analyze_result(self):
+        result = analyze_result(IMAGE_PATH, candidates=2)
+        self.assertEqual(result['contour'], contour_points(IMAGE_PATH))
+        self.assertEqual(list(result['timings']), STAGES)
+        self.assertEqual(len(result['candidates']), 2)
+        self.assertEqual(result['candidates'][0]['area'], result['area'])
+        self.assertGreaterEqual(result['candidates'][0]['area'], result['candidates'][1]['area'])
+        # One JSON message
+        self.assertEqual(json.loads(json.dumps(result)), result)
+
+
+class PipelineTests(unittest.TestCase):
+    def test_scan_stages(self):
+        scan = Scan(path=IMAGE_PATH)
+        self.assertIs(scan.morphed, scan.morphed)
+        self.assertEqual(scan.points, contour_points(IMAGE_PATH))
+        transparent = scan.transparent
+        self.assertEqual(transparent.shape[2], 4)
+        np.testing.assert_array_equal(transparent[:, :, 3] > 0, scan.mask > 0)
+
+    def test_analyze_and_remove_background(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_path = os.path.join(directory, 'out.png')
+            points = analyze_and_remove_background(IMAGE_PATH, output_path)
+            self.assertEqual(points, contour_points(IMAGE_PATH))
+            # The same png as remove_bg.py
+            remove_bg.remove_background(IMAGE_PATH, os.path.join(directory, 'remove_bg.png'))
+            np.testing.assert_array_equal(cv2.imread(output_path, cv2.IMREAD_UNCHANGED),
+                                          cv2.imread(os.path.join(directory, 'remove_bg.png'), cv2.IMREAD_UNCHANGED))
+
+    def test_low_memory_remove_background(self):
+        # The mask of the low memory mode comes from the grayscale read of the file
+        scan = Scan(path=IMAGE_PATH, params=BACKGROUND_PARAMS)
+        scan.gray = cv2.imread(IMAGE_PATH, cv2.IMREAD_GRAYSCALE)
+        transparent = scan.transparent
+        cut_out = remove_bg.cut_out(IMAGE_PATH)
+        np.testing.assert_array_equal(cut_out, transparent)
+        x, y, width, height = cv2.boundingRect(cut_out[:, :, 3])
+        np.testing.assert_array_equal(remove_bg.cut_out(IMAGE_PATH, crop=True),
+                                      cut_out[y:y + height, x:x + width])
+
+    def test_split_tools(self):
+        scan = cv2.imread(IMAGE_PATH)
+        # The same tool twice, a speck of dust and a shadow along the edge
+        white = np.full((scan.shape[0], 100, 3), 255, np.uint8)
+        image = np.hstack([white, scan, white, cv2.flip(scan, 1)])
+        cv2.circle(image, (790, 800), 6, (0, 0, 0), -1)
+        image[:, :15] = 40
+        self.assertEqual(Scan(image=scan).tools()[0].tolist(), Scan(image=scan).largest_contour.tolist())
+        with tempfile.TemporaryDirectory() as directory:
+            cv2.imwrite(os.path.join(directory, 'scan.png'), image)
+            tools = split_tools(os.path.join(directory, 'scan.png'), os.path.join(directory, 'tools'))
+            self.assertEqual([os.path.basename(tool['path']) for tool in tools], ['tool_1', 'tool_2'])
+            self.assertAlmostEqual(tools[0]['area'], tools[1]['area'], delta=0.01 * tools[0]['area'])
+            x, y = tools[1]['bounds'][:2]
+            crop = cv2.imread(os.path.join(tools[1]['path'], 'main.png'))
+            self.assertEqual(crop.shape[:2], tuple(tools[1]['bounds'][:1:-1]))
+            points = np.loadtxt(os.path.join(tools[1]['path'], 'contour.txt'), delimiter=',')
+            np.testing.assert_allclose(points * PIXELS_PER_UNIT + [x, y], tools[1]['contour'])
+            # Every tool folder is fitted, with border the shadows count as tools too
+            fitted = []
+            tools = split_tools(os.path.join(directory, 'scan.png'), os.path.join(directory, 'border'),
+                                border=True, fit=fitted.append)
+            self.assertGreater(len(tools), 2)
+            self.assertEqual(sorted(fitted), sorted(tool['path'] for tool in tools))
+
+    def test_region_of_interest(self):
+        img = np.full((400, 600, 3), 255, np.uint8)
+        # Small tool on the right, larger clutter on the left
+        cv2.fillPoly(img, [np.array([[420, 100], [520, 120], [500, 300], [430, 280]])], (30, 30, 30))
+        cv2.rectangle(img, (20, 20), (300, 380), (60, 60, 60), -1)
+        roi = [380, 60, 180, 280]
+        scan = Scan(image=img, roi=roi)
+        crop = Scan(image=np.ascontiguousarray(img[60:340, 380:560]))
+        self.assertEqual(scan.points, [[x + 380, y + 60] for x, y in crop.points])
+        x, y, width, height = cv2.boundingRect(scan.largest_contour)
+        self.assertTrue(400 < x and x + width < 540 and 80 < y and y + height < 320)
+        self.assertLess(cv2.boundingRect(Scan(image=img).largest_contour)[0], 100)
+        self.assertEqual(Scan(image=img, roi={'x': -10, 'y': 390, 'width': 50, 'height': 50}).bounds, (0, 390, 40, 10))
+        with self.assertRaises(ValueError):
+            Scan(image=img, roi=[700, 0, 10, 10]).bounds
+
+    def test_downscale_accuracy(self):
+        report = downscale_accuracy(IMAGE_PATH, [0.5, 0.25])
+        self.assertEqual([entry['scale'] for entry in report], [1, 0.5, 0.25])
+        self.assertLess(report[1]['mean_mm'], 0.2)
+        # The full resolution refinement brings the contour closer to the reference
+        for entry in report[1:]:
+            self.assertLess(entry['mean_mm'], entry['unrefined_mean_mm'])
+        points = Scan(path=IMAGE_PATH, params=dict(CONTOUR_PARAMS, scale=0.5)).points
+        height, width = cv2.imread(IMAGE_PATH).shape[:2]
+        self.assertTrue(all(0 <= x < width and 0 <= y < height for x, y in points))
+
+
+class LambdaTests(unittest.TestCase):
+    def test_request_forms(self):
+        with open(IMAGE_PATH, 'rb') as file:
+            data = file.read()
+        expected = Scan(path=IMAGE_PATH).approx.tolist()
+        for form, make_event in local.EVENTS.items():
+            for _ in range(2):
+                area = {'x': 0, 'y': 0, 'width': 643, 'height': 1754}
+                response = lambda_function.lambda_handler(make_event(data, area), None)
+                self.assertEqual(response['statusCode'], 200, form)
+                self.assertEqual(json.loads(response['body']), expected, form)
+        response = lambda_function.lambda_handler({'body': 'not base64 json'}, None)
+        self.assertEqual(response['statusCode'], 400)
+
+    def test_bad_area(self):
+        with open(IMAGE_PATH, 'rb') as file:
+            data = file.read()
+        for area in [[99999, 99999, 10, 10], 5, [1, 2, 3], ['a', 0, 10, 10]]:
+            event = {'body': json.dumps({'image': base64.b64encode(data).decode(), 'area': area})}
+            response = lambda_function.lambda_handler(event, None)
+            self.assertEqual(response['statusCode'], 400, area)
+            self.assertIn('Area', json.loads(response['body'])['error'])
+
+    def test_bad_images(self):
+        for data in [b'notanimage', b'']:
+            response = lambda_function.lambda_handler(local.raw_event(data), None)
+            self.assertEqual(response['statusCode'], 400, data)
+        blank = cv2.imencode('.png', np.full((100, 100, 3), 255, np.uint8))[1].tobytes()
+        for make_event in local.EVENTS.values():
+            response = lambda_function.lambda_handler(make_event(blank), None)
+            self.assertEqual(response['statusCode'], 422)
+            self.assertEqual(json.loads(response['body']), {'error': 'NoContourError: No contour found'})
+
+    def test_batch(self):
+        with open(IMAGE_PATH, 'rb') as file:
+            data = file.read()
+        expected = Scan(path=IMAGE_PATH).approx.tolist()
+        event = local.batch_event([data, b'not an image', data])
+        response = lambda_function.lambda_handler(event, None)
+        results = json.loads(response['body'])['results']
+        self.assertEqual(results[0], {'contour': expected})
+        self.assertIn('error', results[1])
+        self.assertEqual(results[2], {'contour': expected})
+        report = local.batch_throughput(data, [1, 2], requests=1)
+        self.assertEqual([entry['batch'] for entry in report], [1, 2])
+
+    def test_multipart_parts(self):
+        body = b'--b\r\nContent-Disposition: form-data; filename="x.png"; name="image"\r\n\r\n' \
+            b'\x00\r\n\xff\r\n--b\r\nContent-Disposition: form-data; name="area"\r\n\r\n[1]\r\n--b--\r\n'
+        parts = lambda_function.multipart_parts(body, 'multipart/form-data; boundary=b')
+        self.assertEqual(bytes(parts['image']), b'\x00\r\n\xff')
+        self.assertEqual(bytes(parts['area']), b'[1]')
+
+
+class CalibrationTests(unittest.TestCase):
+    def test_calibrate(self):
+        # Four 40 mm markers on a sheet at 10 px/mm, photographed at an angle
+        sheet = np.full((1000, 1300), 255, np.uint8)
+        dictionary = cv2.aruco.getPredefinedDictionary(calibration.DICTIONARY)
+        layout = {}
+        for marker, (x, y) in enumerate([(10, 10), (80, 10), (10, 55), (80, 55)]):
+            sheet[y * 10:(y + 40) * 10, x * 10:(x + 40) * 10] = cv2.aruco.generateImageMarker(dictionary, marker, 400)
+            layout[str(marker)] = [x, y]
+        camera = cv2.getPerspectiveTransform(np.float32([[0, 0], [1300, 0], [1300, 1000], [0, 1000]]),
+                                             np.float32([[60, 80], [1250, 30], [1290, 980], [20, 900]]))
+        photo = cv2.warpPerspective(sheet, camera, (1300, 1000), borderValue=255, flags=cv2.INTER_AREA)
+        # Sheet pixel centers are at (i + 0.5) / 10 mm
+        points = cv2.perspectiveTransform(np.float64([[[299.5, 299.5]], [[1099.5, 699.5]]]), camera)
+        result = calibration.calibrate(photo, 40, layout)
+        self.assertEqual(result['markers'], [0, 1, 2, 3])
+        np.testing.assert_allclose(calibration.to_mm(points, result), [[30, 30], [110, 70]], atol=0.05)
+        # Without a layout the largest marker is the origin, one marker extrapolates less accurately
+        start, end = calibration.to_mm(points, calibration.calibrate(photo, 40))
+        np.testing.assert_allclose(np.subtract(end, start), [80, 40], atol=0.2)
+        self.assertIs(calibration.setup_calibration('test', photo, 40),
+                      calibration.setup_calibration('test', photo, 40))
+        with self.assertRaises(ValueError):
+            calibration.calibrate(np.full((100, 100), 255, np.uint8), 40)
+
+    def test_photo(self):
+        image = cv2.imread(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'img', '1.JPEG'))
+        self.assertEqual(calibration.calibrate(image, 50)['markers'], [0, 1, 2, 4, 5, 6])
+
+
+class DiskCacheTests(unittest.TestCase):
+    def test_entries(self):
+        with tempfile.TemporaryDirectory() as directory:
+            disk = cache.DiskCache(directory, 10000)
+            calls = []
+
+            def compute(value):
+                calls.append(value)
+                return value
+
+            values = {'array': np.arange(6, dtype=np.uint8).reshape(2, 3), 'bytes': b'\x89PNG', 'json': {'a': [1, 2.5]}}
+            for key, value in values.items():
+                disk.get(key, lambda: compute(value))
+            for key, value in values.items():
+                np.testing.assert_array_equal(disk.get(key, lambda: compute(None)), value)
+            self.assertEqual(len(calls), 3)
+            self.assertEqual(sorted(os.listdir(directory)), ['array.npy', 'bytes.bin', 'json.json'])
+            # Past the size bound the least recently used entries go
+            os.utime(os.path.join(directory, 'array.npy'), (0, 0))
+            disk.store('large', np.zeros(9800, np.uint8))
+            self.assertEqual(sorted(os.listdir(directory)), ['bytes.bin', 'json.json', 'large.npy'])
+
+    def test_failed_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache')
+            disk = cache.DiskCache(path, 10000)
+            # The cache directory is gone and a file is in its place
+            os.rmdir(path)
+            with open(path, 'w') as file:
+                file.write('not a directory')
+            self.assertFalse(disk.store('key', {'a': 1}))
+            self.assertEqual(disk.get('key', lambda: [1, 2]), [1, 2])
+
+    def test_file_results(self):
+        with tempfile.TemporaryDirectory() as directory:
+            disk, cache.DISK = cache.DISK, cache.DiskCache(directory, 1 << 20)
+            try:
+                calls = []
+                first, second = os.path.join(directory, 'a.png'), os.path.join(directory, 'b.png')
+                for path in [first, second]:
+                    with open(path, 'wb') as file:
+                        file.write(b'scan')
+                for path, params in [(first, 1), (second, 1), (first, 2)]:
+                    cache.cached_file_result('test', path, params, [__file__], lambda: calls.append(path) or params)
+                # The same bytes under another name come from the cache
+                self.assertEqual(calls, [first, first])
+                points = contour_points(IMAGE_PATH)
+                self.assertEqual(contour_points(IMAGE_PATH), points)
+                self.assertEqual(len(os.listdir(directory)), 5)
+            finally:
+                cache.DISK = disk
+
+
+class InstrumentTests(unittest.TestCase):
+    def test_disabled(self):
+        self.assertFalse(instrument.enabled)
+        self.assertIs(instrument.stage('a'), instrument.stage('b'))
+
+    def test_remove_bg_report(self):
+        directory = os.path.dirname(os.path.abspath(__file__))
+        with tempfile.TemporaryDirectory() as output:
+            env = dict(os.environ, FOAMSIZER_PROFILE=os.path.join(output, 'report.json'),
+                       FOAMSIZER_PROFILE_MEMORY='1', FOAMSIZER_CPROFILE=os.path.join(output, 'run.prof'))
+            subprocess.run([sys.executable, 'remove_bg.py', IMAGE_PATH, os.path.join(output, 'out.png')],
+                           cwd=directory, env=env, check=True)
+            with open(os.path.join(output, 'report.json')) as file:
+                report = json.load(file)
+            self.assertTrue(os.path.exists(os.path.join(output, 'run.prof')))
+        summary = report['summary']
+        for name in ['remove_bg.remove_background', 'scan.thresh', 'scan.morphed', 'imwrite']:
+            self.assertEqual(summary[name]['calls'], 1, name)
+        outer = summary['remove_bg.remove_background']
+        self.assertLess(outer['self_wall'], outer['wall'])
+        self.assertGreaterEqual(outer['peak_bytes'], summary['scan.transparent']['peak_bytes'])
+
+    def test_record_limit(self):
+        # Long-lived processes keep only the last records, the report still has the peak memory
+        with tempfile.TemporaryDirectory() as output:
+            path = os.path.join(output, 'report.json')
+            env = dict(os.environ, FOAMSIZER_PROFILE=path, FOAMSIZER_PROFILE_RECORDS='5')
+            code = 'import instrument\nfor _ in range(20):\n    with instrument.stage("a"): pass'
+            subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                           env=env, check=True)
+            with open(path) as file:
+                report = json.load(file)
+        self.assertEqual(len(report['stages']), 5)
+        self.assertEqual(report['summary']['a']['calls'], 5)
+        self.assertGreater(report['max_rss_kb'], 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# Long-lived worker that keeps numpy, scipy, shapely, matplotlib and cv2 loaded.
+# Reads one JSON request per line from stdin and writes one JSON response per line
+# to stdout:
+#   {"id": 1, "method": "find_symmetry_line", "params": {"path": "..."}}
+#   {"id": 1, "result": 512} or {"id": 1, "error": "..."}
+import json
+import os
+import sys
+import traceback
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'shapefitting'))
+
+import calibration  # noqa: E402
+import fitting  # noqa: E402
+import pipeline  # noqa: E402
+import instrument  # noqa: E402
+import nesting  # noqa: E402
+import remove_bg  # noqa: E402
+import symmetry_line  # noqa: E402
+import test  # noqa: E402
+
+
+def ping():
+    return 'pong'
+
+
+def analyze_image(image_path, scale=1, roi=None):
+    return test.contour_points(image_path, scale, roi)
+
+
+def analyze_image_result(image_path, scale=1, candidates=3, roi=None):
+    return test.analyze_result(image_path, scale, candidates, roi)
+
+
+def fit_contour(path, offset, binary=False):
+    # Without the plot: plt.show() would block the worker, and every call queued
+    # behind it, until the window is closed. fitting.py draws in its own process.
+    fitting.run(path, int(offset), False, binary)
+    return True
+
+
+def fit_contour_sweep(path, start, stop, step, processes=None):
+    # Later fit_contour calls for these offsets read the results instead of fitting
+    return fitting.sweep(path, start, stop, step, processes)
+
+
+def nest_contours(paths, offset, width, height):
+    # Tray layout of the contours in paths, each buffered by offset
+    return nesting.nest([fitting.get_points(path, int(offset)) for path in paths], width, height)
+
+
+def find_symmetry_line(path, mode='overlay', max_angle=0):
+    return int(symmetry_line.find_symmetry_line(path, mode, max_angle))
+
+
+def calibrate(image_path, marker_mm, setup=None, layout=None):
+    # Calibrations with a setup name are kept for the next photos of that setup
+    image = pipeline.read_image(image_path)
+    if setup is None:
+        return calibration.calibrate(image, marker_mm, layout)
+    return calibration.setup_calibration(setup, image, marker_mm, layout)
+
+
+def remove_background(input_path, output_path, low_memory=False, crop=False):
+    remove_bg.remove_background(input_path, output_path, low_memory, crop)
+    return True
+
+
+def split_tools(image_path, output_dir, offset=20, min_area=pipeline.MIN_TOOL_AREA, border=False):
+    # One tool folder per tool in the scan, fitted with offset like fit_contour
+    fit = None if offset is None else partial(fitting.run, offset=int(offset))
+    return pipeline.split_tools(image_path, output_dir, min_area=min_area, border=border, fit=fit)
+
+
+def analyze_and_remove_background(input_path, output_path):
+    return pipeline.analyze_and_remove_background(input_path, output_path)
+
+
+def profile_report(reset=False):
+    # Stages recorded so far when the worker runs with FOAMSIZER_PROFILE set, the
+    # last FOAMSIZER_PROFILE_RECORDS of them; reset starts the next report afresh
+    report = instrument.report()
+    if reset:
+        instrument.reset()
+    return report
+
+
+METHODS = {
+    'ping': ping,
+    'analyze_image': analyze_image,
+    'analyze_image_result': analyze_image_result,
+    'fit_contour': fit_contour,
+    'fit_contour_sweep': fit_contour_sweep,
+    'nest_contours': nest_contours,
+    'find_symmetry_line': find_symmetry_line,
+    'calibrate': calibrate,
+    'remove_background': remove_background,
+    'analyze_and_remove_background': analyze_and_remove_background,
+    'split_tools': split_tools,
+    'profile_report': profile_report,
+}
+
+
+def handle(request):
+    response = {'id': request.get('id')}
+    method = METHODS.get(request.get('method'))
+    if method is None:
+        response['error'] = 'Unknown method: {}'.format(request.get('method'))
+        return response
+    try:
+        response['result'] = method(**request.get('params', {}))
+    except Exception as e:
+        response['error'] = '{}: {}'.format(type(e).__name__, e)
+        traceback.print_exc(file=sys.stderr)
+    return response
+
+
+def serve(stdin, stdout):
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {'id': None, 'error': 'Invalid request: {}'.format(e)}
+        else:
+            response = handle(request)
+        stdout.write(json.dumps(response) + '\n')
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    # Anything the scripts print goes to stderr, stdout only carries responses
+    protocol_out = sys.stdout
+    sys.stdout = sys.stderr
+    serve(sys.stdin, protocol_out)
@@ -16,6 +16,7 @@ import path from 'path';
 import { uploadImage } from './aws';
 import { dbFindOne, dbInsertOne, dbReplaceOne } from './db';
 import MenuBuilder from './menu';
+import { callWorker, checkWorkerHealth, stopWorker } from './pythonWorker';
 import { resolveHtmlPath } from './util';
 
 const spawn = require("child_process").spawn;
@@ -130,30 +131,23 @@ async function handleDownloadFile(event:any, url: string, destPath: string) {
 }
 
 async function handleAnalyzeImage (event:any, imgPath: string) {
-  return new Promise((resolve, reject) => {
-    const pyProg = spawn('python', ['./opencv/test.py', imgPath]);
-    var pointString = ''
-    pyProg.stdout.on('data', function(data:any) {
-      // Points are in the format x,y
-      pointString += data.toString()
-    });
-
-    pyProg.on('close', function(code:any) {
-      console.log('Process terminated with code:', code);
-      var points = pointString.split('\n').map((point:any) => {
-        const [x, y] = point.split(',')
-        if (x === '' || y === '') {
-          return null
-        }
-        return [parseInt(x), parseInt(y)]
-      })
-      points = points.filter((point:any) => point !== null)
-      resolve(points);
-    });
-  });
+  try {
+    // One message with the contour, its area, stage timings and candidates.
+    // Points are in the format [x, y]
+    const result = await callWorker('analyze_image_result', { image_path: imgPath })
+    if (isDebug) {
+      console.log('analyzeImage timings:', result.timings)
+    }
+    return result.contour
+  } catch (error) {
+    console.error(error)
+    return []
+  }
 }
 
 async function handleContourFitting(event:any, filePath: string) {
+  // The interactive plot runs in its own process, in the worker it would hold up
+  // every other call until the window is closed
   return new Promise((resolve, reject) => {
     const offset = 20;
     const pyProg = spawn('python', ['./opencv/shapefitting/fitting.py', filePath, offset, true]);
@@ -165,17 +159,12 @@ async function handleContourFitting(event:any, filePath: string) {
 };
 
 async function handleFindSymmetryLine(event:any, filePath: string) {
-  return new Promise((resolve, reject) => {
-    const pyProg = spawn('python', ['./opencv/symmetry_line.py', filePath]);
-    var line = ''
-    pyProg.stdout.on('data', function(data:any) {
-      line += data.toString()
-    });
-    pyProg.on('close', function(code:any) {
-      console.log('Process terminated with code:', code);
-      resolve(line);
-    });
-  });
+  try {
+    return await callWorker('find_symmetry_line', { path: filePath })
+  } catch (error) {
+    console.error(error)
+    return ''
+  }
 }
 
 async function scanImage(event: any, filePath: string) {
@@ -227,13 +216,12 @@ async function handleConvertCoverImage(event:any, imgPath: string, outPath:strin
 }
 
 async function handleRemoveBackground(event:any, inputPath: string, outputPath: string) {
-  return new Promise((resolve, reject) => {
-    const pyProg = spawn('python', ['./opencv/remove_bg.py', inputPath, outputPath]);
-    pyProg.on('close', function(code:any) {
-      console.log('Process terminated with code:', code);
-      resolve(true);
-    });
-  });
+  try {
+    return await callWorker('remove_background', { input_path: inputPath, output_path: outputPath })
+  } catch (error) {
+    console.error(error)
+    return false
+  }
 }
 
 ipcMain.on('ipc-example', async (event, arg) => {
@@ -336,6 +324,10 @@ app.on('window-all-closed', () => {
   }
 });
 
+app.on('will-quit', () => {
+  stopWorker();
+});
+
 app
   .whenReady()
   .then(() => {
@@ -361,6 +353,8 @@ app
     ipcMain.handle('db:replaceOne', dbReplaceOne)
     ipcMain.handle('aws:uploadImage', uploadImage)
     ipcMain.handle('execute:removeBackground', handleRemoveBackground)
+    // Start the python worker early so the first analysis does not pay the imports
+    checkWorkerHealth();
     createWindow();
     app.on('activate', () => {
       // On macOS it's common to re-create a window in the app when the
@@ -0,0 +1,116 @@
+/* eslint no-console: off */
+import { ChildProcess, spawn } from 'child_process';
+import readline from 'readline';
+
+// Keeps one python process (opencv/worker.py) alive so numpy, scipy, shapely,
+// matplotlib and cv2 are only imported once. Requests and responses are JSON
+// lines matched by id. A crashed worker is restarted on the next call.
+
+type Pending = {
+  proc: ChildProcess;
+  resolve: (value: any) => void;
+  reject: (reason: any) => void;
+  timer?: NodeJS.Timeout;
+};
+
+const WORKER_SCRIPT = './opencv/worker.py';
+// Generous because a cold start imports all of the scientific stack
+const HEALTH_CHECK_TIMEOUT = 30000;
+
+let worker: ChildProcess | null = null;
+let nextId = 1;
+const pending = new Map<number, Pending>();
+
+// Removes a request from pending and stops its timeout, if it is still waiting
+function takePending(id: number) {
+  const request = pending.get(id);
+  if (request) {
+    pending.delete(id);
+    clearTimeout(request.timer);
+  }
+  return request;
+}
+
+function rejectPending(proc: ChildProcess, reason: string) {
+  pending.forEach((request, id) => {
+    if (request.proc === proc) {
+      takePending(id);
+      request.reject(new Error(reason));
+    }
+  });
+}
+
+function startWorker() {
+  const proc = spawn('python', [WORKER_SCRIPT]);
+  readline.createInterface({ input: proc.stdout! }).on('line', (line) => {
+    let response: any;
+    try {
+      response = JSON.parse(line);
+    } catch (error) {
+      console.error('Invalid worker response:', line);
+      return;
+    }
+    const request = takePending(response.id);
+    if (!request) {
+      return;
+    }
+    if (response.error) {
+      request.reject(new Error(response.error));
+    } else {
+      request.resolve(response.result);
+    }
+  });
+  proc.stderr!.on('data', (data: any) => {
+    console.error(data.toString());
+  });
+  proc.on('exit', (code: any) => {
+    console.log('Python worker terminated with code:', code);
+    if (worker === proc) {
+      worker = null;
+    }
+    rejectPending(proc, `Python worker exited with code ${code}`);
+  });
+  proc.on('error', (error: any) => {
+    console.error(error);
+  });
+  worker = proc;
+  return proc;
+}
+
+// Rejects after timeout milliseconds when given, a late response is then ignored
+export function callWorker(method: string, params: object = {}, timeout?: number) {
+  const proc = worker || startWorker();
+  const id = nextId;
+  nextId += 1;
+  return new Promise<any>((resolve, reject) => {
+    const request: Pending = { proc, resolve, reject };
+    if (timeout !== undefined) {
+      request.timer = setTimeout(() => {
+        takePending(id);
+        reject(new Error(`Python worker did not answer ${method} in ${timeout} ms`));
+      }, timeout);
+    }
+    pending.set(id, request);
+    proc.stdin!.write(`${JSON.stringify({ id, method, params })}\n`);
+  });
+}
+
+export function stopWorker() {
+  if (worker) {
+    worker.kill();
+    worker = null;
+  }
+}
+
+// Pings the worker and restarts it when it does not answer in time
+export async function checkWorkerHealth() {
+  const healthy = await callWorker('ping', {}, HEALTH_CHECK_TIMEOUT).then(
+    (result) => result === 'pong',
+    () => false,
+  );
+  if (!healthy) {
+    stopWorker();
+    startWorker();
+  }
+  return healthy;
+}